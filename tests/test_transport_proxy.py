@@ -7,7 +7,17 @@ NOTE: These are Unit Tests, they should test function behaviour based on input d
       Integration Tests/Continuous Monitoring tests.
 """
 
+import http.client
+import urllib.parse
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
 import pytest
+import transport_proxy
 
 # ---------------------------------------------      warm-up        -------------------------------------------------- #
 
@@ -16,3 +26,1333 @@ def test_initial():
     Most basic test to ensure pytest DEFINITELY works
     """
     assert True == True
+
+# ---------------------------------------------      helpers        -------------------------------------------------- #
+
+def get_free_port():
+    """
+    Get free TCP port on localhost
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_app(use_asyncio=False, use_http=False, unix_socket=None):
+    """
+    Start Application with Executor Thread and listener, no ChromeDriver involved.
+    Only getEcho and other browser-free queries can be executed.
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    app.host = '127.0.0.1'
+    app.port = get_free_port()
+    app.query_delay = 0
+    app.use_asyncio = use_asyncio
+    app.unix_socket = unix_socket
+    app.executor_threads = [transport_proxy.ExecutorThread(app, LineCore())]
+    app.executor_threads[0].start()
+    if use_http:
+        app.http_port = get_free_port()
+        app.http_gateway = transport_proxy.HttpGatewayThread(app)
+        assert app.http_gateway.bind()
+        app.http_gateway.start()
+    listen_thread = threading.Thread(target=app.listen)
+    listen_thread.start()
+    for _ in range(50):
+        try:
+            socket.create_connection((app.host, app.port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    return app, listen_thread
+
+
+def stop_app(app, listen_thread):
+    """
+    Stop Application started with start_app
+    """
+    app.is_running = False
+    if app.http_gateway is not None:
+        app.http_gateway.stop()
+    listen_thread.join()
+    app.executor_threads[0].join()
+
+
+def receive_messages(sock, count):
+    """
+    Receive "count" JSON messages separated by '\\n\\0'
+    """
+    buffer = b''
+    while buffer.count(b'\n\0') < count:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buffer += data
+    return [json.loads(msg) for msg in buffer.split(b'\n\0') if msg]
+
+# ---------------------------------------------    server modes     -------------------------------------------------- #
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_echo_round_trip(use_asyncio):
+    """
+    getEcho should be acknowledged and executed in both threaded and asyncio server modes
+    """
+    app, listen_thread = start_app(use_asyncio)
+    try:
+        sock = socket.create_connection((app.host, app.port))
+        sock.sendall(b'getEcho?id=1?hello\ngetEcho?id=2?world\n')
+        messages = receive_messages(sock, 4)
+        sock.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert messages[0] == {'id': '1', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    results = [msg for msg in messages if 'method' in msg]
+    assert [msg['data'] for msg in results] == ['hello', 'world']
+    assert all(msg['expect_more_data'] is False for msg in results)
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_unix_socket(use_asyncio, tmp_path):
+    """
+    Same protocol should be served over Unix domain socket and TCP at the same time
+    """
+    path = str(tmp_path / 'proxy.sock')
+    app, listen_thread = start_app(use_asyncio, unix_socket=path)
+    try:
+        unix_socks = []
+        for i in range(2):
+            unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            unix_sock.connect(path)
+            unix_socks.append(unix_sock)
+            unix_sock.sendall(bytes('getEcho?id=' + str(i) + '?unix' + str(i) + '\n', 'utf-8'))
+        tcp_sock = socket.create_connection((app.host, app.port))
+        tcp_sock.sendall(b'getEcho?id=2?tcp\n')
+        results = [receive_messages(sock, 2)[-1]['data'] for sock in unix_socks + [tcp_sock]]
+        for sock in unix_socks + [tcp_sock]:
+            sock.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert results == ['unix0', 'unix1', 'tcp']
+    assert not os.path.exists(path)
+
+
+def test_unix_socket_stale_file(tmp_path):
+    """
+    Stale socket file should be replaced, regular file and socket of a running server should be left as is
+    """
+    path = str(tmp_path / 'proxy.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    sock = transport_proxy.Application.make_unix_listen_socket(path, 1)
+    with pytest.raises(OSError, match='in use'):
+        transport_proxy.Application.make_unix_listen_socket(path, 1)
+    sock.close()
+    assert os.path.exists(path)
+
+    regular = tmp_path / 'regular'
+    regular.write_text('data')
+    with pytest.raises(OSError, match='not a socket'):
+        transport_proxy.Application.make_unix_listen_socket(str(regular), 1)
+    assert regular.read_text() == 'data'
+
+@pytest.mark.parametrize("use_http", [False, True])
+def test_descriptors_above_select_limit(use_http):
+    """
+    Connections with descriptor numbers above FD_SETSIZE (1024) should be served
+    """
+    resource = pytest.importorskip("resource")
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1200:
+        pytest.skip("not enough descriptors allowed")
+    padding = [os.open(os.devnull, os.O_RDONLY) for _ in range(1100)]
+    app, listen_thread = start_app(use_http=use_http)
+    try:
+        if use_http:
+            client = http.client.HTTPConnection(app.host, app.http_port, timeout=10)
+            client.request('GET', '/getEcho?id=1&url=hello')
+            response = client.getresponse()
+            assert response.status == 200
+            result = [json.loads(line) for line in response.read().splitlines()][-1]
+            client.close()
+        else:
+            sock = socket.create_connection((app.host, app.port))
+            sock.settimeout(10)
+            sock.sendall(b'getEcho?id=1?hello\n')
+            result = receive_messages(sock, 2)[-1]
+            sock.close()
+    finally:
+        stop_app(app, listen_thread)
+        for fd in padding:
+            os.close(fd)
+
+    assert result['data'] == 'hello'
+
+# ---------------------------------------------     LineFramer      -------------------------------------------------- #
+
+def test_line_framer_partial_lines():
+    """
+    Partial line should be kept between feeds, several lines in one feed should all be extracted
+    """
+    framer = transport_proxy.LineFramer(max_line_length=1024)
+    assert framer.feed(b'getEcho?id=1?hel') == []
+    assert framer.pending
+    assert framer.feed(b'lo\r\ngetEcho?id=2?a\ngetEcho') == ['getEcho?id=1?hello\r', 'getEcho?id=2?a']
+    assert framer.flush() == 'getEcho'
+    assert not framer.pending
+
+
+def test_line_framer_multibyte_split():
+    """
+    UTF-8 character split between two feeds should be decoded correctly
+    """
+    framer = transport_proxy.LineFramer(max_line_length=1024)
+    data = 'getEcho?id=1?Привет\n'.encode('utf-8')
+    assert framer.feed(data[:15]) == []
+    assert framer.feed(data[15:]) == ['getEcho?id=1?Привет']
+
+
+def test_line_framer_max_length():
+    """
+    Lines exceeding max_line_length should be reported once as None and dropped up to the line break
+    """
+    framer = transport_proxy.LineFramer(max_line_length=8)
+    assert framer.feed(b'0123456789') == [None]
+    assert framer.feed(b'0123456789') == []
+    assert framer.feed(b'abc\nshort\n') == ['short']
+    assert framer.feed(b'0123456789abc\n') == [None]
+    assert not framer.pending
+
+
+def test_line_framer_flush_after_max_length():
+    """
+    Tail of too long line should not be reported again at the end of the stream, or parsed as a new query
+    """
+    framer = transport_proxy.LineFramer(max_line_length=8)
+    assert framer.feed(b'0123456789') == [None]
+    assert framer.feed(b'01') == []
+    assert framer.flush() is None
+    assert framer.feed(b'23\nshort\n') == ['short']
+    assert framer.flush() is None
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_query_split_between_segments(use_asyncio):
+    """
+    Query split between two TCP segments should be processed as a single query
+    """
+    app, listen_thread = start_app(use_asyncio)
+    try:
+        sock = socket.create_connection((app.host, app.port))
+        sock.sendall(b'getEcho?id=1?hel')
+        time.sleep(0.05)
+        sock.sendall(b'lo\n')
+        messages = receive_messages(sock, 2)
+        sock.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert messages[1]['data'] == 'hello'
+
+# ---------------------------------------------   outbound queue    -------------------------------------------------- #
+
+@pytest.mark.parametrize("policy", [transport_proxy.ClientConnection.POLICY_DISCONNECT,
+                                    transport_proxy.ClientConnection.POLICY_DROP_OLDEST])
+def test_outbound_queue_overflow(policy):
+    """
+    Overflowing outbound queue of a stalled client should either disconnect it or drop oldest messages
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    app.send_queue_size = 10
+    app.send_queue_policy = policy
+    server_sock, client_sock = socket.socketpair()
+    # Writer thread is not started, so the client is effectively stalled
+    conn = transport_proxy.SocketConnection(app, server_sock, 'test')
+    assert conn.send(b'12345') == 5
+    assert conn.send(b'67890') == 5
+    if policy == transport_proxy.ClientConnection.POLICY_DISCONNECT:
+        assert conn.send(b'abc') == 0
+        assert conn.closed
+        assert client_sock.recv(16) == b''
+    else:
+        assert conn.send(b'abc') == 3
+        assert not conn.closed
+        assert list(conn.queue) == [b'67890', b'abc']
+    conn.close()
+    client_sock.close()
+    server_sock.close()
+
+
+def test_outbound_queue_writer():
+    """
+    Writer thread should deliver queued messages in order
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    server_sock, client_sock = socket.socketpair()
+    conn = transport_proxy.SocketConnection(app, server_sock, 'test')
+    conn.start()
+    for i in range(100):
+        conn.send(bytes(str(i) + ',', 'utf-8'))
+    expected = ''.join(str(i) + ',' for i in range(100)).encode('utf-8')
+    received = b''
+    while len(received) < len(expected):
+        received += client_sock.recv(4096)
+    conn.close()
+    conn.writer.join()
+    client_sock.close()
+    assert received == expected
+
+class ShortWriteSocket:
+    """
+    Socket replacement accepting at most "limit" bytes per sendmsg call
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = 0
+        self.received = b''
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(data) for data in buffers)[:self.limit]
+        self.received += data
+        return len(data)
+
+
+def test_send_buffers_short_writes():
+    """
+    Partially sent buffers should be continued, all messages of a response should be queued at once
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    conn = transport_proxy.SocketConnection(app, ShortWriteSocket(7), 'test')
+    assert conn.send_messages([{'id': str(i), 'expect_more_data': i < 2} for i in range(3)]) == 118
+    messages = conn.next_messages()
+    assert len(messages) == 3
+    conn.send_buffers(messages)
+    assert conn.sock.received == b''.join(messages)
+    assert conn.sock.calls == 17
+
+# ---------------------------------------------      framing        -------------------------------------------------- #
+
+def receive_frame(stream):
+    """
+    Receive one length-prefixed binary frame from a socket file object
+    """
+    length = struct.unpack('!I', stream.read(4))[0]
+    return stream.read(length)
+
+
+def test_check_options():
+    """
+    Invalid or inconsistent framing options should be rejected
+    """
+    conn = transport_proxy.ClientConnection
+    assert conn.check_options({}) is None
+    assert conn.check_options({'framing': 'binary', 'compression': 'zlib'}) is None
+    assert conn.check_options({'framing': 'text', 'compression': 'zlib'}) is not None
+    assert conn.check_options({'framing': 'carrier pigeon'}) is not None
+    assert conn.check_options({'speed': 'fast'}) is not None
+
+
+def test_encode_message_binary():
+    """
+    Binary framing should produce length-prefixed, optionally compressed and MessagePack-encoded frames
+    """
+    app = transport_proxy.Application()
+    conn, client_sock = make_connection(app)
+    conn.close()
+    client_sock.close()
+    message = {'id': '1', 'data': 'x' * 1000}
+    assert conn.encode_message(message) == bytes(json.dumps(message) + '\n\0', 'utf-8')
+
+    conn.framing = conn.FRAMING_BINARY
+    conn.compression = conn.COMPRESSION_ZLIB
+    frame = conn.encode_message(message)
+    assert struct.unpack('!I', frame[:4])[0] == len(frame) - 4
+    assert json.loads(zlib.decompress(frame[4:])) == message
+
+    msgpack = pytest.importorskip("msgpack")
+    conn.compression = conn.COMPRESSION_NONE
+    conn.encoding = conn.ENCODING_MSGPACK
+    assert msgpack.unpackb(conn.encode_message(message)[4:]) == message
+
+
+def test_set_options_round_trip():
+    """
+    After setOptions reply (sent with old framing) all messages should use the new framing
+    """
+    app, listen_thread = start_app(use_asyncio=True)
+    try:
+        sock = socket.create_connection((app.host, app.port))
+        sock.sendall(b'setOptions?id=opt?framing=binary&compression=zlib\ngetEcho?id=1?hello\n')
+        stream = sock.makefile('rb')
+        reply = json.loads(stream.readline())
+        assert stream.read(1) == b'\0'
+        ack = json.loads(zlib.decompress(receive_frame(stream)))
+        result = json.loads(zlib.decompress(receive_frame(stream)))
+        sock.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert reply == {'id': 'opt', 'response': 'OK', 'framing': 'binary',
+                     'compression': 'zlib', 'encoding': 'json', 'priority': 'normal', 'client': None}
+    assert ack['queue_position'] == 0
+    assert result['data'] == 'hello'
+
+# ---------------------------------------------    HTTP gateway     -------------------------------------------------- #
+
+def test_http_gateway_keep_alive():
+    """
+    Several requests should be served over one keep-alive HTTP connection, payload streamed as JSON lines
+    """
+    app, listen_thread = start_app(use_asyncio=True, use_http=True)
+    try:
+        client = http.client.HTTPConnection(app.host, app.http_port, timeout=10)
+        results = []
+        for text in ('hello', 'world'):
+            client.request('GET', '/getEcho?id=' + text + '&url=' + text)
+            response = client.getresponse()
+            assert response.status == 200
+            assert response.getheader('Transfer-Encoding') == 'chunked'
+            assert response.getheader('X-Query-Id') == text
+            results.append([json.loads(line) for line in response.read().splitlines()])
+
+        client.request('GET', '/getNothing?url=x')
+        response = client.getresponse()
+        assert response.status == 404
+        response.read()
+        client.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert [entries[0]['data'] for entries in results] == ['hello', 'world']
+    assert all(entries[-1]['expect_more_data'] is False for entries in results)
+
+
+def test_http_gateway_errors_and_disconnect():
+    """
+    Invalid requests should be answered with HTTP 400, query of a client which is gone should leave the Query Queue
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    app.host = '127.0.0.1'
+    app.http_port = get_free_port()
+    app.http_gateway = transport_proxy.HttpGatewayThread(app)
+    assert app.http_gateway.bind()
+    app.http_gateway.start()
+    try:
+        client = http.client.HTTPConnection(app.host, app.http_port, timeout=10)
+        for params in ({'id': 'a?b', 'url': LINE_URL}, {'url': LINE_URL, 'since': 'yesterday'}):
+            client.request('GET', '/getLine?' + urllib.parse.urlencode(params))
+            response = client.getresponse()
+            assert response.status == 400
+            assert json.loads(response.read())['response'] == 'ERROR'
+
+        # No Executor Thread, the query stays queued until the client disconnects
+        client.request('GET', '/getLine?' + urllib.parse.urlencode({'id': 'a&b', 'url': LINE_URL}))
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.getheader('X-Query-Id') == 'a&b'
+        assert response.getheader('X-Eta') == '0'
+        assert [query['id'] for query in json.loads(app.get_current_queue())] == ['a&b']
+        client.close()
+        for _ in range(30):
+            if not json.loads(app.get_current_queue()):
+                break
+            time.sleep(0.1)
+        assert json.loads(app.get_current_queue()) == []
+    finally:
+        app.is_running = False
+        app.http_gateway.stop()
+
+# ---------------------------------------------    subscriptions    -------------------------------------------------- #
+
+STOP_URL = 'https://yandex.ru/maps/213/moscow/?masstransit%5BstopId%5D=stop__9640231&mode=stop'
+LINE_URL = 'https://yandex.ru/maps/213/moscow/routes/bus_1/'
+
+
+def make_preload_app(cache_ttl=120):
+    """
+    Make Application with PreloadWorker (not started) watching STOP_URL
+    """
+    app = transport_proxy.Application()
+    app.log.verbose = 0
+    config = {'enabled': True, 'refresh_interval': 30, 'cache_ttl': cache_ttl,
+              'stops': [{'name': 'Test Stop', 'url': STOP_URL, 'methods': ['getStopInfo']}]}
+    app.preload_worker = transport_proxy.PreloadWorker(app, None, config)
+    return app
+
+
+def make_stop_data(stop_id, arrival):
+    """
+    Make data in YandexTransportCore format for STOP_URL
+    """
+    return [{'url': STOP_URL, 'method': 'getStopInfo', 'error': 'OK',
+             'data': {'data': {'id': stop_id, 'arrival': arrival}}}]
+
+
+def make_connection(app):
+    """
+    Make SocketConnection connected to a socketpair, returns connection and client socket
+    """
+    server_sock, client_sock = socket.socketpair()
+    conn = transport_proxy.SocketConnection(app, server_sock, 'test')
+    conn.start()
+    return conn, client_sock
+
+
+class LineCore:
+    """
+    YandexTransportCore replacement answering getLine queries without a browser
+    """
+    def __init__(self):
+        self.calls = []
+
+    def get_line(self, url, on_entry=None):
+        self.calls.append(url)
+        return [{'url': url, 'method': 'getLine', 'error': 'OK', 'data': {'line': url}}], 0
+
+    def get_methods_info(self, url, methods, on_entry=None):
+        self.calls.append((url, methods))
+        return [{'url': url, 'method': method, 'error': 'OK', 'data': {method: url}} for method in methods], 0
+
+    def switch_to_main_tab(self):
+        pass
+
+
+def test_subscribe_stop():
+    """
+    Subscriber should get current data right away and each refresh after that, until unsubscribed
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    conn, client_sock = make_connection(app)
+
+    app.process_query('subscribeStop?id=sub1?' + STOP_URL, 'test', conn)
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:05'), 0)
+    ack, snapshot, update = receive_messages(client_sock, 3)
+    assert ack == {'id': 'sub1', 'response': 'OK', 'subscribed': STOP_URL}
+    assert snapshot['data']['data']['arrival'] == '10:00'
+    assert update['id'] == 'sub1'
+    assert update['subscription'] == STOP_URL
+    assert update['data']['data']['arrival'] == '10:05'
+    assert update['expect_more_data'] is False
+
+    app.process_query('unsubscribe?id=sub2?' + STOP_URL, 'test', conn)
+    assert receive_messages(client_sock, 1)[0]['response'] == 'OK'
+    assert STOP_URL not in app.subscriptions
+
+    app.process_query('subscribeStop?id=sub3?https://yandex.ru/maps/unknown', 'test', conn)
+    assert receive_messages(client_sock, 1)[0]['response'] == 'ERROR'
+
+    app.process_query('subscribeStop?id=sub4?' + STOP_URL, 'test', conn)
+    receive_messages(client_sock, 2)
+    # Pushed update should not complete a query in flight with the same ID
+    conn.inflight.add('sub4')
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:10'), 0)
+    assert receive_messages(client_sock, 1)[0]['subscription'] == STOP_URL
+    assert 'sub4' in conn.inflight
+    conn.close()
+    client_sock.close()
+    assert STOP_URL not in app.subscriptions
+
+# ---------------------------------------------     pipelining      -------------------------------------------------- #
+
+def test_pipelined_cache_hit_overtakes_queued_query():
+    """
+    Cache hit should be answered right away even if an earlier query of the same connection is still queued,
+    duplicate ID of a query in flight should be rejected, and the ID can be reused once the query completes.
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getEcho?id=slow?hello', 'test', conn)
+    app.process_query('getStopInfo?id=fast?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=slow?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=fast?' + STOP_URL, 'test', conn)
+    messages = receive_messages(client_sock, 6)
+    conn.close()
+    client_sock.close()
+
+    assert messages[0] == {'id': 'slow', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    assert messages[1] == {'id': 'fast', 'response': 'OK', 'queue_position': -1, 'eta': 0}
+    assert messages[2]['id'] == 'fast'
+    assert messages[2]['method'] == 'getStopInfo'
+    assert messages[2]['expect_more_data'] is False
+    assert messages[3]['id'] == 'slow'
+    assert messages[3]['response'] == 'ERROR'
+    assert messages[4] == {'id': 'fast', 'response': 'OK', 'queue_position': -1, 'eta': 0}
+
+
+def test_ack_sent_before_data(monkeypatch):
+    """
+    Acknowledgment should be sent before any data of the query, even if the executor is faster than the sender
+    """
+    app = make_preload_app()
+    estimate_start = app.estimate_start
+
+    def slow_estimate_start(position):
+        time.sleep(0.05)
+        return estimate_start(position)
+
+    monkeypatch.setattr(app, 'estimate_start', slow_estimate_start)
+    executor = transport_proxy.ExecutorThread(app, LineCore())
+    executor.start()
+    conn, client_sock = make_connection(app)
+    try:
+        app.process_query('getEcho?id=e?hello', 'test', conn)
+        app.process_query('getBatch?id=b?' + json.dumps([['getLine', LINE_URL]]), 'test', conn)
+        messages = receive_messages(client_sock, 4)
+    finally:
+        app.is_running = False
+        executor.join()
+        conn.close()
+        client_sock.close()
+
+    for query_id in ('e', 'b'):
+        query_messages = [message for message in messages if message['id'] == query_id]
+        assert query_messages[0]['response'] == 'OK'
+        assert query_messages[1]['expect_more_data'] is False
+
+# ---------------------------------------------     projection      -------------------------------------------------- #
+
+def test_project_fields():
+    """
+    Projection should keep only requested paths and preserve structure of the value
+    """
+    value = {'data': {'properties': {'name': 'Stop',
+                                     'StopMetaData': {'id': 'stop__1',
+                                                      'Transport': [{'name': '90', 'threads': [1, 2]},
+                                                                    {'name': '91', 'threads': [3]}]}}}}
+    paths = transport_proxy.Application.parse_fields('data.properties.name,'
+                                                     'data.properties.StopMetaData.Transport.*.name')
+    assert transport_proxy.Application.project(value, paths) == \
+        {'data': {'properties': {'name': 'Stop', 'StopMetaData': {'Transport': [{'name': '90'}, {'name': '91'}]}}}}
+    paths = transport_proxy.Application.parse_fields('data.properties.StopMetaData.Transport.1,data.name.deeper')
+    assert transport_proxy.Application.project(value, paths) == \
+        {'data': {'properties': {'StopMetaData': {'Transport': [{'name': '91', 'threads': [3]}]}}}}
+    assert transport_proxy.Application.parse_fields('arrivals')[0] == ['data', 'properties', 'name']
+    with pytest.raises(ValueError):
+        transport_proxy.Application.parse_fields('data..name')
+
+
+def test_get_stop_info_fields():
+    """
+    "fields" parameter should be applied both to cache hits and executed queries
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    core = LineCore()
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getStopInfo?id=q1?fields=data.id?' + STOP_URL, 'test', conn)
+    app.process_query('getLine?id=q2?fields=line?' + LINE_URL, 'test', conn)
+    transport_proxy.ExecutorThread(app, core).perform_query_extraction_and_execution()
+    app.process_query('getStopInfo?id=q3?fields=data..id?' + STOP_URL, 'test', conn)
+    messages = receive_messages(client_sock, 5)
+    conn.close()
+    client_sock.close()
+
+    assert messages[1]['data'] == {'data': {'id': 'stop__1'}}
+    assert messages[2] == {'id': 'q2', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    assert messages[3]['data'] == {'line': LINE_URL}
+    assert core.calls == [LINE_URL]
+    assert messages[4] == {'id': 'q3', 'response': 'ERROR', 'message': 'Invalid fields: "data..id"'}
+
+# ---------------------------------------------     coalescing      -------------------------------------------------- #
+
+def test_identical_queries_coalesced():
+    """
+    Identical queued queries should be executed once, result goes to every requester
+    """
+    app = make_preload_app()
+    core = LineCore()
+    # Results of executed queries are not reused
+    app.result_cache.ttl = 0
+    conn1, client_sock1 = make_connection(app)
+    conn2, client_sock2 = make_connection(app)
+
+    app.process_query('getLine?id=a?' + LINE_URL + '?x=1&y=2', 'test', conn1)
+    app.process_query('getLine?id=b?fields=line?' + LINE_URL + '?y=2&x=1', 'test', conn2)
+    app.process_query('getEcho?id=c?hello', 'test', conn2)
+    app.process_query('getLine?id=d?' + LINE_URL + '?x=1&y=2#stop', 'test', conn2)
+    assert len(app.query_queue) == 2
+    assert json.loads(app.get_current_queue())[0]['waiters'] == 2
+
+    executor = transport_proxy.ExecutorThread(app, core)
+    executor.perform_query_extraction_and_execution()
+    # Query being executed does not take new waiters
+    app.process_query('getLine?id=e?' + LINE_URL + '?x=1&y=2', 'test', conn1)
+    executor.perform_query_extraction_and_execution()
+    messages1 = receive_messages(client_sock1, 3)
+    messages2 = receive_messages(client_sock2, 6)
+    for sock in (client_sock1, client_sock2):
+        sock.close()
+
+    assert core.calls == [LINE_URL + '?x=1&y=2']
+    assert messages1[1]['id'] == 'a'
+    assert messages1[1]['data'] == {'line': LINE_URL + '?x=1&y=2'}
+    assert messages1[2] == {'id': 'e', 'response': 'OK', 'queue_position': 1, 'eta': 5}
+    assert [message['id'] for message in messages2] == ['b', 'c', 'd', 'b', 'd', 'c']
+    assert messages2[2]['queue_position'] == 0
+    assert messages2[3]['data'] == {'line': LINE_URL + '?x=1&y=2'}
+    assert 'e' in conn1.inflight
+
+def test_same_url_queries_grouped():
+    """
+    Queued queries of different methods for the same URL should be executed with a single page load
+    """
+    app = make_preload_app()
+    core = LineCore()
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+    app.process_query('getEcho?id=b?hello', 'test', conn)
+    app.process_query('getStopInfo?id=c?' + LINE_URL, 'test', conn)
+    app.process_query('getStopInfo?id=d?' + LINE_URL, 'test', conn)
+    app.process_query('getEcho?id=e?' + LINE_URL, 'test', conn)
+    app.process_query('getEcho?id=f?' + LINE_URL, 'test', conn)
+    executor = transport_proxy.ExecutorThread(app, core)
+    executor.perform_query_extraction_and_execution()
+    assert [query['id'] for query in app.query_queue] == ['b', 'e', 'f']
+    for _ in range(3):
+        executor.perform_query_extraction_and_execution()
+    messages = receive_messages(client_sock, 12)
+    conn.close()
+    client_sock.close()
+
+    assert core.calls == [(LINE_URL, ('getStopInfo', 'getLine'))]
+    entries = {message['id']: message for message in messages[6:]}
+    assert entries['a']['data'] == {'getLine': LINE_URL}
+    assert entries['c']['data'] == {'getStopInfo': LINE_URL}
+    assert entries['d']['data'] == {'getStopInfo': LINE_URL}
+    assert entries['b']['data'] == 'hello'
+    # getEcho is never coalesced or grouped
+    assert entries['e']['data'] == entries['f']['data'] == LINE_URL
+    assert [message['id'] for message in messages[6:]] == ['a', 'c', 'd', 'b', 'e', 'f']
+
+def test_cached_data_filtered_by_method():
+    """
+    Data cached while the query was queued should answer it with entries of its method only,
+    and only if it has entries of that method
+    """
+    app = make_preload_app()
+    executor = transport_proxy.ExecutorThread(app, LineCore())
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getStopInfo?id=a?' + STOP_URL, 'test', conn)
+    line_entry = {'url': STOP_URL, 'method': 'getLine', 'error': 'OK', 'data': {'line': 'cached'}}
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00') + [line_entry], 0)
+    executor.perform_query_extraction_and_execution()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:05'), 0)
+    app.process_query('getLine?id=b?' + STOP_URL, 'test', conn)
+    executor.perform_query_extraction_and_execution()
+    messages = receive_messages(client_sock, 4)
+    conn.close()
+    client_sock.close()
+
+    assert [(message['id'], message['method']) for message in messages if 'method' in message] == \
+        [('a', 'getStopInfo'), ('b', 'getLine')]
+    assert messages[3]['data'] == {'line': STOP_URL}
+    assert executor.core.calls == [STOP_URL]
+
+
+def test_recent_results_reused(monkeypatch):
+    """
+    Results of executed queries should answer later queries for any of the loaded methods until they expire
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    app = make_preload_app()
+    core = LineCore()
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+    app.process_query('getStopInfo?id=b?' + LINE_URL, 'test', conn)
+    transport_proxy.ExecutorThread(app, core).perform_query_extraction_and_execution()
+    now[0] += 5
+    app.process_query('getStopInfo?id=c?fields=getStopInfo?' + LINE_URL.replace('yandex.ru', 'Yandex.RU'), 'test', conn)
+    app.process_query('getLine?id=d?' + LINE_URL, 'test', conn)
+    now[0] += 10
+    app.process_query('getLine?id=e?' + LINE_URL, 'test', conn)
+    messages = receive_messages(client_sock, 9)
+    conn.close()
+    client_sock.close()
+
+    assert core.calls == [(LINE_URL, ('getStopInfo', 'getLine'))]
+    assert messages[4] == {'id': 'c', 'response': 'OK', 'queue_position': -1, 'eta': 0}
+    assert messages[5]['id'] == 'c' and messages[5]['data'] == {'getStopInfo': LINE_URL}
+    assert messages[7]['id'] == 'd' and messages[7]['data'] == {'getLine': LINE_URL}
+    # Expired results are not used
+    assert messages[8] == {'id': 'e', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+
+# ---------------------------------------------     priorities      -------------------------------------------------- #
+
+def test_query_queue_priority_aging(monkeypatch):
+    """
+    Queries should be ordered by priority class, old enough low priority query should get ahead of newer ones
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    queue = transport_proxy.QueryQueue(aging=60)
+    low = {'id': 'low', 'priority': 'low'}
+    queue.append(low)
+    now[0] += 10
+    queue.append({'id': 'normal1'})
+    queue.append({'id': 'high', 'priority': 'high'})
+    queue.append({'id': 'normal2'})
+    assert [query['id'] for query in queue] == ['high', 'normal1', 'normal2', 'low']
+
+    now[0] += 100
+    queue.append({'id': 'normal3'})
+    assert [query['id'] for query in queue] == ['high', 'normal1', 'normal2', 'low', 'normal3']
+    queue.promote(low, 'high')
+    assert queue.index(low) == 0
+    queue.remove(low)
+    assert len(queue) == 4
+
+
+def test_query_queue_client_backlog(monkeypatch):
+    """
+    Client should be penalized for its queued queries only, not for the queries already served
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    queue = transport_proxy.QueryQueue(share=5)
+    flood = [{'id': 'flood' + str(number), 'client': 'flood'} for number in range(10)]
+    for query in flood:
+        queue.append(query)
+    assert flood[-1]['virtual_time'] == 1045
+    while len(queue):
+        queue.popleft()
+    assert not queue.clocks
+
+    now[0] += 1
+    queue.append({'id': 'again', 'client': 'flood'})
+    queue.append({'id': 'other', 'client': 'other'})
+    assert [query['id'] for query in queue] == ['again', 'other']
+    assert queue[0]['virtual_time'] == 1001
+
+
+def test_priority_from_parameter_and_options():
+    """
+    Priority class should come from query parameter or from connection default set with setOptions
+    """
+    app = make_preload_app()
+    conn, client_sock = make_connection(app)
+
+    app.process_query('setOptions?id=opt?priority=low', 'test', conn)
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+    app.process_query('getLine?id=b?priority=high?' + LINE_URL + '?b', 'test', conn)
+    app.process_query('getLine?id=c?priority=urgent?' + LINE_URL, 'test', conn)
+    messages = receive_messages(client_sock, 4)
+    queue = json.loads(app.get_current_queue())
+    conn.close()
+    client_sock.close()
+
+    assert messages[0]['priority'] == 'low'
+    assert messages[2] == {'id': 'b', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    assert messages[3] == {'id': 'c', 'response': 'ERROR', 'message': 'Invalid priority: "urgent"'}
+    assert [(entry['id'], entry['priority']) for entry in queue] == [('b', 'high'), ('a', 'low')]
+
+def test_fair_queuing():
+    """
+    Queries of a client flooding the queue should be interleaved with queries of other clients,
+    number of queued queries of one client should be limited
+    """
+    app = make_preload_app()
+    app.max_client_queries = 4
+    flood_conn, flood_sock = make_connection(app)
+    nice_conn, nice_sock = make_connection(app)
+
+    app.process_query('setOptions?id=opt?client=flood', 'test', flood_conn)
+    app.process_query('setOptions?id=opt?client=nice', 'test', nice_conn)
+    app.process_query('setOptions?id=bad?client=no spaces', 'test', nice_conn)
+    for number in range(5):
+        app.process_query('getLine?id=' + str(number) + '?' + LINE_URL + '?' + str(number), 'test', flood_conn)
+    app.process_query('getLine?id=a?' + LINE_URL + '?a', 'test', nice_conn)
+    app.process_query('getLine?id=b?' + LINE_URL + '?b', 'test', nice_conn)
+    batch = [['getLine', LINE_URL + '?' + suffix] for suffix in 'cde']
+    app.process_query('getBatch?id=c?' + json.dumps(batch), 'test', nice_conn)
+    flood_messages = receive_messages(flood_sock, 6)
+    nice_messages = receive_messages(nice_sock, 5)
+    queue = json.loads(app.get_current_queue())
+    for conn, sock in ((flood_conn, flood_sock), (nice_conn, nice_sock)):
+        conn.close()
+        sock.close()
+
+    assert nice_messages[1] == {'id': 'bad', 'response': 'ERROR', 'message': 'Unsupported client: no spaces'}
+    assert flood_messages[5] == {'id': '4', 'response': 'OVERLOADED',
+                                 'message': 'Too many queued queries of client "flood"', 'queue_length': 4, 'eta': 20}
+    assert nice_messages[4]['message'] == 'Too many queued queries of client "nice"'
+    assert [entry['id'] for entry in queue] == ['0', 'a', '1', 'b', '2', '3']
+    assert queue[1]['client'] == 'nice'
+
+
+def test_client_id():
+    """
+    Client is identified by its host, each connection to Unix domain socket is a client of its own
+    """
+    app = transport_proxy.Application()
+    conn, client_sock = make_connection(app)
+    conn.close()
+    client_sock.close()
+    conn.addr = ('10.0.0.1', 40000)
+    assert conn.get_client_id() == '10.0.0.1'
+    conn.addr = ('unix:/run/proxy.sock', 3)
+    assert conn.get_client_id() == 'unix:/run/proxy.sock:3'
+    conn.client_id = 'declared'
+    assert conn.get_client_id() == 'declared'
+
+# ---------------------------------------------      streaming      -------------------------------------------------- #
+
+class StreamCore:
+    """
+    YandexTransportCore replacement extracting getStopInfo and getLine entries one by one,
+    checks that the first entry reached the client before the second one is extracted
+    """
+    def __init__(self, client_sock, fail=False):
+        self.client_sock = client_sock
+        self.fail = fail
+        self.received = []
+
+    def get_all_info(self, url, on_entry=None):
+        data = [{'url': url, 'method': 'getStopInfo', 'error': 'OK', 'data': {'stop': url}},
+                {'url': url, 'method': 'getLine', 'error': 'OK', 'data': {'line': url}}]
+        on_entry(data[0], ['getLine'])
+        self.received = receive_messages(self.client_sock, 3)
+        if self.fail:
+            return None, transport_proxy.YandexTransportCore.RESULT_GET_ERROR
+        on_entry(data[1], [])
+        return data, 0
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_entries_streamed(fail):
+    """
+    Entries should be sent as soon as they are extracted, "expect_more_data" should be False only for the last
+    entry of each query, response should be closed with the error if the page load fails midway
+    """
+    app = make_preload_app()
+    conn, client_sock = make_connection(app)
+    core = StreamCore(client_sock, fail)
+
+    app.process_query('getAllInfo?id=a?' + LINE_URL, 'test', conn)
+    app.process_query('getLine?id=b?' + LINE_URL, 'test', conn)
+    transport_proxy.ExecutorThread(app, core).perform_query_extraction_and_execution()
+    messages = receive_messages(client_sock, 2)
+    conn.close()
+    client_sock.close()
+
+    assert core.received[2] == {'id': 'a', 'method': 'getStopInfo', 'error': 0, 'message': 'OK',
+                                    'expect_more_data': True, 'data': {'stop': LINE_URL}}
+    if fail:
+        assert [(message['id'], message['error'], message['expect_more_data']) for message in messages] == \
+            [('a', 2, False), ('b', 2, False)]
+    else:
+        assert [(message['id'], message['method'], message['expect_more_data']) for message in messages] == \
+            [('a', 'getLine', False), ('b', 'getLine', False)]
+
+
+# ---------------------------------------------    rate limiting    -------------------------------------------------- #
+
+def test_token_bucket(monkeypatch):
+    """
+    Token bucket should allow "burst" page loads at once, then one per "interval" seconds
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    bucket = transport_proxy.TokenBucket(interval=10, burst=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 10
+    now[0] += 4
+    assert bucket.try_acquire() == pytest.approx(6)
+    now[0] += 100
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 10]
+    assert transport_proxy.TokenBucket(interval=0).try_acquire() == 0
+    assert transport_proxy.TokenBucket(interval=10, burst=0).try_acquire() == 0
+
+
+def test_executor_wakes_up_on_query():
+    """
+    Executor should execute queries as soon as they are queued, only page loads should wait for the rate limiter
+    """
+    app = make_preload_app()
+    core = LineCore()
+    app.query_delay = 60
+    executor = transport_proxy.ExecutorThread(app, core)
+    executor.start()
+    conn, client_sock = make_connection(app)
+    try:
+        time.sleep(0.2)
+        started = time.monotonic()
+        app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+        app.process_query('getEcho?id=e?hello', 'test', conn)
+        messages = receive_messages(client_sock, 4)
+        elapsed = time.monotonic() - started
+        # Second page load has to wait for the next token
+        app.process_query('getLine?id=b?' + LINE_URL + '?b', 'test', conn)
+        messages += receive_messages(client_sock, 1)
+        time.sleep(0.2)
+    finally:
+        app.is_running = False
+        executor.join()
+        conn.close()
+        client_sock.close()
+
+    assert elapsed < 1
+    assert sorted(msg['id'] for msg in messages if 'method' in msg) == ['a', 'e']
+    assert messages[-1] == {'id': 'b', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    assert core.calls == [LINE_URL]
+
+
+class SlowLineCore(LineCore):
+    """
+    LineCore taking some time to load a page
+    """
+    def get_line(self, url, on_entry=None):
+        time.sleep(0.5)
+        return super().get_line(url)
+
+
+@pytest.mark.parametrize("query_delay, expected_calls", [(0, 3), (60, 1)])
+def test_executor_pool(query_delay, expected_calls):
+    """
+    Executor Threads of the pool should load pages in parallel, within the rate limit shared by all of them
+    """
+    app = make_preload_app()
+    rate_limiter = transport_proxy.TokenBucket(query_delay)
+    cores = [SlowLineCore() for _ in range(3)]
+    app.executor_threads = [transport_proxy.ExecutorThread(app, core, rate_limiter) for core in cores]
+    for executor_thread in app.executor_threads:
+        executor_thread.start()
+    conn, client_sock = make_connection(app)
+    try:
+        started = time.monotonic()
+        for number in range(3):
+            app.process_query('getLine?id=' + str(number) + '?' + LINE_URL + '?' + str(number), 'test', conn)
+        messages = receive_messages(client_sock, 3 + expected_calls)
+        elapsed = time.monotonic() - started
+        time.sleep(0.2)
+        # Queries waiting for the rate limiter stay in the queue
+        queue_len = len(app.query_queue)
+    finally:
+        app.is_running = False
+        for executor_thread in app.executor_threads:
+            executor_thread.join()
+        conn.close()
+        client_sock.close()
+
+    assert elapsed < 1
+    assert len([msg for msg in messages if 'method' in msg]) == expected_calls
+    assert sorted(len(core.calls) for core in cores) == ([1, 1, 1] if query_delay == 0 else [0, 0, 1])
+    assert queue_len == 3 - expected_calls
+
+
+def test_query_waits_for_token_in_queue(monkeypatch):
+    """
+    Query waiting for the rate limiter should stay queued, so identical queries are attached to it
+    and its deadline is checked once the token is available
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(transport_proxy.time, 'sleep', lambda seconds: None)
+    app = make_preload_app()
+    rate_limiter = transport_proxy.TokenBucket(60)
+    assert rate_limiter.try_acquire() == 0
+    executor = transport_proxy.ExecutorThread(app, LineCore(), rate_limiter)
+    conn1, client_sock1 = make_connection(app)
+    conn2, client_sock2 = make_connection(app)
+
+    app.process_query('getLine?id=a?deadline=30?' + LINE_URL, 'test', conn1)
+    executor.perform_query_extraction_and_execution()
+    assert not app.query_queue[0].get('executing')
+    app.process_query('getLine?id=b?' + LINE_URL, 'test', conn2)
+    assert len(app.query_queue) == 1
+    now[0] += 61
+    executor.perform_query_extraction_and_execution()
+    messages1 = receive_messages(client_sock1, 2)
+    messages2 = receive_messages(client_sock2, 2)
+    for sock in (conn1, conn2, client_sock1, client_sock2):
+        sock.close()
+
+    assert messages1[1]['message'] == 'Deadline exceeded'
+    assert messages2[1]['id'] == 'b' and messages2[1]['data'] == {'line': LINE_URL}
+    assert executor.core.calls == [LINE_URL]
+    assert len(app.query_queue) == 0
+
+
+# ---------------------------------------------    cancellation     -------------------------------------------------- #
+
+def test_queries_dropped_on_disconnect():
+    """
+    Queued queries of closed connection should not be executed, identical queries of other clients should
+    """
+    app = make_preload_app()
+    core = LineCore()
+    conn1, client_sock1 = make_connection(app)
+    conn2, client_sock2 = make_connection(app)
+
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn1)
+    app.process_query('getLine?id=b?' + LINE_URL, 'test', conn2)
+    app.process_query('getLine?id=c?' + LINE_URL + '?c', 'test', conn2)
+    receive_messages(client_sock2, 2)
+    conn2.close()
+    client_sock2.close()
+    assert [query['id'] for query in app.query_queue] == ['a']
+    assert list(app.pending_queries) == [('getLine', LINE_URL)]
+
+    executor = transport_proxy.ExecutorThread(app, core)
+    executor.perform_query_extraction_and_execution()
+    messages = receive_messages(client_sock1, 2)
+    conn1.close()
+    client_sock1.close()
+
+    assert messages[1]['id'] == 'a'
+    assert core.calls == [LINE_URL]
+    assert len(app.query_queue) == 0
+
+
+def test_deadline(monkeypatch):
+    """
+    Queries should be dropped without execution when their deadline passes while they are queued
+    """
+    now = [1000.0]
+    monkeypatch.setattr(transport_proxy.time, 'monotonic', lambda: now[0])
+    app = make_preload_app()
+    core = LineCore()
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getLine?id=a?deadline=5?' + LINE_URL, 'test', conn)
+    app.process_query('getLine?id=b?deadline=60?' + LINE_URL + '?b', 'test', conn)
+    app.process_query('getLine?id=c?deadline=soon?' + LINE_URL, 'test', conn)
+    now[0] += 10
+    transport_proxy.ExecutorThread(app, core).perform_query_extraction_and_execution()
+    messages = receive_messages(client_sock, 5)
+    conn.close()
+    client_sock.close()
+
+    assert messages[2] == {'id': 'c', 'response': 'ERROR', 'message': 'Invalid deadline: "soon"'}
+    assert messages[3] == {'id': 'a', 'method': 'getLine', 'error': 5, 'message': 'Deadline exceeded',
+                           'expect_more_data': False}
+    assert messages[4]['id'] == 'b' and messages[4]['error'] == 0
+    assert core.calls == [LINE_URL + '?b']
+
+
+# ---------------------------------------------    load shedding    -------------------------------------------------- #
+
+def test_overloaded_and_eta():
+    """
+    Queries above maximum Query Queue length should be rejected, acknowledgments should carry estimated start time
+    """
+    app = make_preload_app()
+    app.max_queue = 2
+    app.record_execution_time(8)
+    app.record_execution_time(3)
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+    app.process_query('getLine?id=b?' + LINE_URL + '?b', 'test', conn)
+    app.process_query('getLine?id=c?' + LINE_URL + '?c', 'test', conn)
+    app.process_query('getLine?id=d?' + LINE_URL, 'test', conn)
+    app.process_query('getBatch?id=e?[["getLine", "' + LINE_URL + '?e"]]', 'test', conn)
+    messages = receive_messages(client_sock, 5)
+    conn.close()
+    client_sock.close()
+
+    assert app.execution_time == pytest.approx(7)
+    assert messages[1] == {'id': 'b', 'response': 'OK', 'queue_position': 1, 'eta': 7}
+    assert messages[2] == {'id': 'c', 'response': 'OVERLOADED', 'message': 'Query Queue is full',
+                           'queue_length': 2, 'eta': 14}
+    # Identical query is attached to the queued one
+    assert messages[3] == {'id': 'd', 'response': 'OK', 'queue_position': 0, 'eta': 0}
+    assert messages[4]['response'] == 'OVERLOADED'
+    assert 'c' not in conn.inflight and 'e' not in conn.inflight
+
+
+# ---------------------------------------------    work stealing    -------------------------------------------------- #
+
+def test_preload_worker_steals_work():
+    """
+    Preload browser should execute queued queries between refresh cycles, if there is time before the next one
+    """
+    app = make_preload_app()
+    app.query_delay = 0
+    config = dict(app.preload_worker.config, work_stealing=True)
+    preload_core = LineCore()
+    worker = transport_proxy.PreloadWorker(app, preload_core, config)
+    conn, client_sock = make_connection(app)
+
+    # Average page load does not fit before the next cycle
+    app.execution_time = 10
+    app.process_query('getLine?id=a?' + LINE_URL, 'test', conn)
+    worker.wait_for_next_cycle(time.monotonic() + 0.5)
+    assert preload_core.calls == []
+
+    app.execution_time = 0.1
+    started = time.monotonic()
+    worker.wait_for_next_cycle(started + 0.5)
+    elapsed = time.monotonic() - started
+    messages = receive_messages(client_sock, 2)
+    conn.close()
+    client_sock.close()
+
+    assert preload_core.calls == [LINE_URL]
+    assert messages[1]['id'] == 'a' and messages[1]['data'] == {'line': LINE_URL}
+    assert len(app.query_queue) == 0
+    assert 0.5 <= elapsed < 1.5
+
+
+# ---------------------------------------------       deltas        -------------------------------------------------- #
+
+def test_make_json_patch():
+    """
+    JSON Patch should contain only changed values, lists of different length are replaced whole
+    """
+    base = {'a': 1, 'b': {'c': [1, 2], 'd': 'x/y'}, 'e': [1], 'f': True}
+    value = {'a': 1, 'b': {'c': [1, 3], 'g': None}, 'e': [1, 2], 'f': 1}
+    assert transport_proxy.Application.make_json_patch(base, value) == [
+        {'op': 'remove', 'path': '/b/d'},
+        {'op': 'replace', 'path': '/b/c/1', 'value': 3},
+        {'op': 'add', 'path': '/b/g', 'value': None},
+        {'op': 'replace', 'path': '/e', 'value': [1, 2]},
+        {'op': 'replace', 'path': '/f', 'value': 1}]
+    assert transport_proxy.Application.make_json_patch(base, base) == []
+    assert transport_proxy.Application.make_merge_patch(base, value) == \
+        {'b': {'c': [1, 3], 'd': None, 'g': None}, 'e': [1, 2], 'f': 1}
+
+
+def test_get_stop_info_since():
+    """
+    Query with known base version should get delta, with unknown one - full data
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:05'), 0)
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getStopInfo?id=q1?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=q2?since=1?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=q3?since=1?delta=merge?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=q4?since=7?' + STOP_URL, 'test', conn)
+    app.process_query('getStopInfo?id=q5?since=1?delta=diff?' + STOP_URL, 'test', conn)
+    messages = receive_messages(client_sock, 9)
+    conn.close()
+    client_sock.close()
+
+    full, patch, merge, fallback = messages[1], messages[3], messages[5], messages[7]
+    assert full['version'] == 2
+    assert full['data']['data']['arrival'] == '10:05'
+    assert patch['version'] == 2
+    assert patch['base_version'] == 1
+    assert patch['delta'] == [{'op': 'replace', 'path': '/data/arrival', 'value': '10:05'}]
+    assert 'data' not in patch
+    assert merge['delta'] == {'data': {'arrival': '10:05'}}
+    assert fallback['data'] == full['data']
+    assert 'base_version' not in fallback
+    assert messages[8] == {'id': 'q5', 'response': 'ERROR', 'message': 'Invalid delta: "diff"'}
+
+def test_get_stop_info_if_none_match():
+    """
+    Query with etag of current data should get "Not modified", etag should change with the data
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    conn, client_sock = make_connection(app)
+
+    app.process_query('getStopInfo?id=q1?' + STOP_URL, 'test', conn)
+    etag = receive_messages(client_sock, 2)[1]['etag']
+    app.process_query('getStopInfo?id=q2?ifNoneMatch=' + etag + '?' + STOP_URL, 'test', conn)
+    not_modified = receive_messages(client_sock, 2)[1]
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:05'), 0)
+    app.process_query('getStopInfo?id=q3?ifNoneMatch=' + etag + '?' + STOP_URL, 'test', conn)
+    modified = receive_messages(client_sock, 2)[1]
+    conn.close()
+    client_sock.close()
+
+    assert not_modified == {'id': 'q2', 'method': 'getStopInfo',
+                            'error': transport_proxy.Application.RESULT_NOT_MODIFIED, 'message': 'Not modified',
+                            'expect_more_data': False, 'version': 1, 'etag': etag}
+    assert modified['data']['data']['arrival'] == '10:05'
+    assert modified['etag'] != etag
+
+
+def test_etag_covers_returned_data_only():
+    """
+    etag should depend only on "data" of the entries returned for the method of the query
+    """
+    app = make_preload_app()
+    worker = app.preload_worker
+    data = make_stop_data('stop__1', '10:00')
+    worker.update_cache(STOP_URL, data, 0)
+    etag = worker.cache[STOP_URL]['etags']['getStopInfo']
+
+    other = {'url': STOP_URL, 'method': 'getLine', 'error': 'OK', 'data': {'line': 1}}
+    worker.update_cache(STOP_URL, [dict(data[0], url=STOP_URL + '&ll=37.6'), other], 0)
+    etags = worker.cache[STOP_URL]['etags']
+    assert etags['getStopInfo'] == etag
+    assert etags['getLine'] != etag
+    assert etags['getAllInfo'] not in (etag, etags['getLine'])
+
+# ---------------------------------------------       batches       -------------------------------------------------- #
+
+def test_get_batch():
+    """
+    Batch items found in preload cache should be answered right away, only misses should be queued,
+    every entry is tagged with its item, the batch ends with the last completed item.
+    """
+    app = make_preload_app()
+    app.preload_worker.update_cache(STOP_URL, make_stop_data('stop__1', '10:00'), 0)
+    core = LineCore()
+    conn, client_sock = make_connection(app)
+
+    batch = [['getLine', LINE_URL], ['getStopInfo', STOP_URL]]
+    app.process_query('getBatch?id=b1?' + json.dumps(batch), 'test', conn)
+    ack, hit = receive_messages(client_sock, 2)
+    assert ack == {'id': 'b1', 'response': 'OK', 'items': 2, 'cached': 1, 'queue_position': 0, 'eta': 0}
+    assert hit['item'] == 1
+    assert hit['item_done'] is True
+    assert hit['data']['data']['arrival'] == '10:00'
+    assert hit['expect_more_data'] is True
+    assert [query['item'] for query in app.query_queue] == [0]
+
+    transport_proxy.ExecutorThread(app, core).perform_query_extraction_and_execution()
+    miss = receive_messages(client_sock, 1)[0]
+    assert core.calls == [LINE_URL]
+    assert miss['id'] == 'b1'
+    assert miss['item'] == 0
+    assert miss['data'] == {'line': LINE_URL}
+    assert miss['expect_more_data'] is False
+    assert 'b1' not in conn.inflight
+
+    app.process_query('getBatch?id=b2?[["getEcho", "hello"]]', 'test', conn)
+    assert receive_messages(client_sock, 1)[0]['response'] == 'ERROR'
+    conn.close()
+    client_sock.close()
+
+# ---------------------------------------------       backlog       -------------------------------------------------- #
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_many_simultaneous_connections(use_asyncio):
+    """
+    Connections opened at once should all be accepted and served
+    """
+    app, listen_thread = start_app(use_asyncio)
+    try:
+        socks = [socket.create_connection((app.host, app.port)) for _ in range(12)]
+        for i, sock in enumerate(socks):
+            sock.sendall(bytes('getEcho?id=' + str(i) + '?hello' + str(i) + '\n', 'utf-8'))
+        results = [receive_messages(sock, 2)[-1]['data'] for sock in socks]
+        for sock in socks:
+            sock.close()
+    finally:
+        stop_app(app, listen_thread)
+
+    assert results == ['hello' + str(i) for i in range(12)]
@@ -20,33 +20,446 @@ __maintainer__ = "Yury D."
 __email__ = "TheOwlSoul@gmail.com"
 __status__ = "Beta"
 
+import os
+import stat
 import time
 import sys
+import asyncio
 import json
 import signal
 import socket
+import select
 import re
 import threading
+import struct
+import bisect
+import zlib
+import hashlib
+import queue
+import itertools
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from collections import deque
 from collections import defaultdict
+from collections import OrderedDict
 import argparse
+import abc
 import setproctitle
 from yandex_transport_core import YandexTransportCore, Logger
 
+# Optional packages, only needed if a client requests MessagePack encoding or zstd compression
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
-def chunks(arr, n):
+class LineFramer:
+    """
+    Incremental line framer for the request stream. Keeps partial line between reads, so a query split
+    across several TCP segments is assembled before being processed. Each complete line is decoded only once.
+    """
+    def __init__(self, max_line_length):
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+        # Part of the buffer before this offset is already known to have no line breaks
+        self.scan_offset = 0
+        # Set when current line exceeded max_line_length, the rest of it is dropped until next line break
+        self.discarding = False
+
+    @property
+    def pending(self):
+        """
+        True if there is a partial line in the buffer
+        """
+        return len(self.buffer) > 0
+
+    def feed(self, data):
+        """
+        Add received data to the buffer and extract all complete lines
+        :param data: bytes received from the connection
+        :return: list of complete lines (strings), None instead of each line which exceeded max_line_length
+        """
+        self.buffer += data
+        lines = []
+        start = 0
+        while True:
+            pos = self.buffer.find(b'\n', self.scan_offset)
+            if pos < 0:
+                break
+            if self.discarding:
+                self.discarding = False
+            elif pos - start > self.max_line_length:
+                lines.append(None)
+            else:
+                lines.append(self.buffer[start:pos].decode('utf-8', errors='replace'))
+            start = pos + 1
+            self.scan_offset = start
+        del self.buffer[:start]
+        self.scan_offset = len(self.buffer)
+
+        if len(self.buffer) > self.max_line_length:
+            if not self.discarding:
+                lines.append(None)
+            self.discarding = True
+            self.buffer.clear()
+            self.scan_offset = 0
+
+        return lines
+
+    def flush(self):
+        """
+        Extract partial line from the buffer at the end of the stream, used for clients which do not terminate
+        their last query with a line break. Tail of a line which exceeded max_line_length was already reported
+        by feed, so it is dropped and the framer keeps discarding until next line break.
+        :return: partial line (string), None if there is nothing to process
+        """
+        line = None
+        if self.buffer and not self.discarding:
+            line = self.buffer.decode('utf-8', errors='replace')
+        self.buffer.clear()
+        self.scan_offset = 0
+        return line
+
+
+class ClientConnection(abc.ABC):
     """
-    Helper function to slice array into smaller size chunks.
-    Is used in "send_message".
-    :param arr: an array
-    :param n: size of a chunk
-    :return: array of n-sized chunks
+    Client connection with its own bounded outbound queue. Sending only puts serialized bytes to the queue,
+    actual writing to the client is done by the connection writer, so a slow client never blocks the sender.
     """
-    for i in range(0, len(arr), n):
-        # Create an index range for l of n items:
-        yield arr[i:i+n]
+    # Outbound queue overflow policies
+    POLICY_DISCONNECT = 'disconnect'
+    POLICY_DROP_OLDEST = 'drop_oldest'
+
+    # Response framing options, negotiated with "setOptions" query
+    FRAMING_TEXT = 'text'
+    FRAMING_BINARY = 'binary'
+    COMPRESSION_NONE = 'none'
+    COMPRESSION_ZLIB = 'zlib'
+    COMPRESSION_ZSTD = 'zstd'
+    ENCODING_JSON = 'json'
+    ENCODING_MSGPACK = 'msgpack'
+
+    def __init__(self, app, addr):
+        self.app = app
+        self.addr = addr
+        # Outbound queue, and total size of data in it, in bytes
+        self.queue = deque()
+        self.queue_size = 0
+        self.queue_lock = threading.Lock()
+        self.closed = False
+
+        # Response framing, messages are encoded and queued under encode_lock,
+        # so framing change never reorders messages
+        self.framing = self.FRAMING_TEXT
+        self.compression = self.COMPRESSION_NONE
+        self.encoding = self.ENCODING_JSON
+        self.zstd_compressor = None
+        self.encode_lock = threading.RLock()
+
+        # IDs of queries acknowledged but not completed yet, many queries can be in flight at once
+        self.inflight = set()
+        # IDs of active subscriptions, kept apart from queries in flight, pushed updates never complete a query
+        self.subscriptions = set()
+
+        # Default priority class of queries of this connection, negotiated with "setOptions" query
+        self.priority = QueryQueue.PRIORITY_NORMAL
+        # Client identity for fair queuing, declared with "setOptions" query, host of the client if not declared
+        self.client_id = None
+
+    @classmethod
+    def check_options(cls, options):
+        """
+        Check options requested by "setOptions" query
+        :param options: dictionary of options
+        :return: error message, None if options are valid
+        """
+        framing = options.get('framing', cls.FRAMING_TEXT)
+        compression = options.get('compression', cls.COMPRESSION_NONE)
+        encoding = options.get('encoding', cls.ENCODING_JSON)
+        priority = options.get('priority', QueryQueue.PRIORITY_NORMAL)
+        client = options.get('client')
+        for key in options:
+            if key not in ('framing', 'compression', 'encoding', 'priority', 'client'):
+                return 'Unknown option: ' + key
+        if framing not in (cls.FRAMING_TEXT, cls.FRAMING_BINARY):
+            return 'Unsupported framing: ' + framing
+        if compression not in (cls.COMPRESSION_NONE, cls.COMPRESSION_ZLIB, cls.COMPRESSION_ZSTD):
+            return 'Unsupported compression: ' + compression
+        if encoding not in (cls.ENCODING_JSON, cls.ENCODING_MSGPACK):
+            return 'Unsupported encoding: ' + encoding
+        if priority not in QueryQueue.PRIORITIES:
+            return 'Unsupported priority: ' + priority
+        if client is not None and re.fullmatch(r'[\w.:-]{1,64}', client) is None:
+            return 'Unsupported client: ' + client
+        if framing == cls.FRAMING_TEXT and (compression != cls.COMPRESSION_NONE or encoding != cls.ENCODING_JSON):
+            return 'Compression and encoding require binary framing'
+        if compression == cls.COMPRESSION_ZSTD and zstandard is None:
+            return 'zstd compression is not available on this server'
+        if encoding == cls.ENCODING_MSGPACK and msgpack is None:
+            return 'MessagePack encoding is not available on this server'
+        return None
+
+    def set_options(self, options, reply):
+        """
+        Send reply using current framing, then switch to new framing options.
+        :param options: dictionary of options, already checked with check_options
+        :param reply: reply message
+        :return: nothing
+        """
+        with self.encode_lock:
+            self.send_message(reply, log_tag='setOptions')
+            self.framing = options.get('framing', self.FRAMING_TEXT)
+            self.compression = options.get('compression', self.COMPRESSION_NONE)
+            self.encoding = options.get('encoding', self.ENCODING_JSON)
+            self.priority = options.get('priority', QueryQueue.PRIORITY_NORMAL)
+            self.client_id = options.get('client')
+            if self.compression == self.COMPRESSION_ZSTD:
+                self.zstd_compressor = zstandard.ZstdCompressor()
+
+    def get_client_id(self):
+        """
+        Get identity of the client for fair queuing
+        :return: client ID declared with "setOptions" query, host of the client if not declared,
+                 connection of the client for Unix domain socket
+        """
+        if self.client_id is not None:
+            return self.client_id
+        if not isinstance(self.addr, tuple):
+            return str(self.addr)
+        # Clients of Unix domain socket are unnamed, each connection is a client of its own
+        if str(self.addr[0]).startswith('unix:'):
+            return str(self.addr[0]) + ':' + str(self.addr[1])
+        return str(self.addr[0])
+
+    def encode_message(self, message):
+        """
+        Serialize message according to connection framing options.
+        Text framing: JSON + '\n' + '\0'.
+        Binary framing: 4 bytes big-endian length, then the body encoded with JSON or MessagePack and compressed
+        with zlib or zstd if requested.
+        :param message: message (dictionary or list)
+        :return: bytes
+        """
+        if self.framing == self.FRAMING_TEXT:
+            return bytes(json.dumps(message) + '\n' + '\0', 'utf-8')
+
+        if self.encoding == self.ENCODING_MSGPACK:
+            body = msgpack.packb(message, use_bin_type=True)
+        else:
+            body = json.dumps(message).encode('utf-8')
+        if self.compression == self.COMPRESSION_ZLIB:
+            body = zlib.compress(body)
+        elif self.compression == self.COMPRESSION_ZSTD:
+            body = self.zstd_compressor.compress(body)
+        return struct.pack('!I', len(body)) + body
+
+    def send_message(self, message, log_tag=None):
+        """
+        Serialize message and put it to the outbound queue
+        :param message: message (dictionary or list)
+        :param log_tag: tag which will append to log message
+        :return: number of bytes queued for sending, 0 if the message was not queued
+        """
+        return self.send_messages([message], log_tag)
+
+    def send_messages(self, messages, log_tag=None):
+        """
+        Serialize messages (usually all entries of one response) and put them to the outbound queue at once,
+        so the writer sends them together.
+        :param messages: list of messages (dictionaries or lists)
+        :param log_tag: tag which will append to log message
+        :return: number of bytes queued for sending, 0 if the messages were not queued
+        """
+        log_tag_text = " (" + log_tag + ")" if log_tag is not None else ""
+        with self.encode_lock:
+            buffers = [self.encode_message(message) for message in messages]
+            size = sum(len(data) for data in buffers)
+
+            if self.app.network_log_enabled:
+                self.app.log.debug("Writing to " + self.app.network_log_file + " "
+                                   "(" + str(size) + " bytes) ")
+                with open(self.app.network_log_file, 'ab') as f:
+                    for data in buffers:
+                        f.write(bytes(str(len(data)) + '\n', 'utf-8'))
+                        f.write(data)
+                        f.write(bytes('\n\n', 'utf-8'))
+
+            self.app.log.debug("Sending response " +
+                               "(" + str(size) + " bytes in " + str(len(buffers)) + " messages) "
+                               "to " + str(self.addr) + log_tag_text)
+
+            bytes_send = self.send_many(buffers)
+            # Last message of the query, its ID can be reused from now on
+            for message in messages:
+                if not isinstance(message, dict) or message.get('expect_more_data') is not False:
+                    continue
+                if 'subscription' in message and message.get('id') in self.subscriptions:
+                    continue
+                self.inflight.discard(message.get('id'))
+        if bytes_send != size:
+            self.app.log.error("Queued " + str(bytes_send) + " out of " + str(size) + " bytes "
+                               "for " + str(self.addr) + log_tag_text)
+        return bytes_send
+
+    def send(self, data):
+        """
+        Put data to the outbound queue, safe to call from any thread.
+        :param data: bytes to send
+        :return: number of bytes queued for sending, 0 if the data was not queued
+        """
+        return self.send_many([data])
+
+    def send_many(self, buffers):
+        """
+        Put several messages to the outbound queue at once, either all of them are queued or none.
+        Safe to call from any thread.
+        :param buffers: list of bytes to send
+        :return: number of bytes queued for sending, 0 if the data was not queued
+        """
+        size = sum(len(data) for data in buffers)
+        with self.queue_lock:
+            if self.closed:
+                return 0
+
+            if self.queue and self.queue_size + size > self.app.send_queue_size:
+                if self.app.send_queue_policy == self.POLICY_DROP_OLDEST:
+                    while self.queue and self.queue_size + size > self.app.send_queue_size:
+                        self.queue_size -= len(self.queue.popleft())
+                    self.app.log.warning("Outbound queue overflow for " + str(self.addr) +
+                                         ", oldest messages dropped")
+                else:
+                    self.app.log.warning("Outbound queue overflow for " + str(self.addr) +
+                                         ", disconnecting")
+                    self._close()
+                    return 0
+
+            self.queue.extend(buffers)
+            self.queue_size += size
+            self.wakeup()
+        return size
+
+    def next_messages(self):
+        """
+        Get all messages from the outbound queue, should be called with queue_lock acquired.
+        :return: list of bytes, empty if the queue is empty
+        """
+        messages = list(self.queue)
+        self.queue.clear()
+        self.queue_size = 0
+        return messages
+
+    def close(self):
+        """
+        Close the connection, all data still in outbound queue is discarded.
+        :return: nothing
+        """
+        with self.queue_lock:
+            self._close()
+        self.app.connection_closed(self)
+
+    def _close(self):
+        """
+        Close the connection, should be called with queue_lock acquired.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queue_size = 0
+        self.wakeup()
+        self.shutdown()
+
+    @abc.abstractmethod
+    def wakeup(self):
+        """
+        Notify the writer about new data or closing of the connection, called with queue_lock acquired.
+        """
+
+    @abc.abstractmethod
+    def shutdown(self):
+        """
+        Shutdown underlying transport, called with queue_lock acquired.
+        """
+
+
+class SocketConnection(ClientConnection):
+    """
+    Client connection over plain socket, outbound queue is drained by a dedicated writer thread.
+    """
+    # Maximum number of buffers passed to single sendmsg call, stays well below IOV_MAX
+    SENDMSG_MAX_BUFFERS = 64
+
+    def __init__(self, app, sock, addr):
+        super().__init__(app, addr)
+        self.sock = sock
+        self.queue_ready = threading.Condition(self.queue_lock)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+
+    def start(self):
+        """
+        Start the writer thread
+        """
+        self.writer.start()
+
+    def wakeup(self):
+        self.queue_ready.notify()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_loop(self):
+        """
+        Writer thread main loop, sends data from the outbound queue to the client.
+        """
+        while True:
+            with self.queue_ready:
+                while not self.queue and not self.closed:
+                    self.queue_ready.wait()
+                if self.closed:
+                    break
+                messages = self.next_messages()
+
+            try:
+                self.send_buffers(messages)
+            except OSError as e:
+                self.app.log.error("Failed to send data to " + str(self.addr))
+                self.app.log.error("Exception (write_loop):" + str(e))
+                self.close()
+                break
+        self.sock.close()
+
+    def send_buffers(self, buffers):
+        """
+        Write all buffers to the socket with as few system calls as possible. Buffers are passed to sendmsg
+        as they are, partially sent buffer is continued with a memoryview, nothing is joined or copied.
+        :param buffers: list of bytes
+        :return: nothing, raises OSError if sending failed
+        """
+        # sendmsg is not available on Windows
+        if not hasattr(self.sock, 'sendmsg'):
+            for data in buffers:
+                self.sock.sendall(data)
+            return
+
+        buffers = deque(memoryview(data) for data in buffers)
+        while buffers:
+            sent = self.sock.sendmsg(itertools.islice(buffers, self.SENDMSG_MAX_BUFFERS))
+            while sent > 0:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.popleft())
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
 
 
 class ListenerThread(threading.Thread):
@@ -56,231 +469,886 @@ class ListenerThread(threading.Thread):
     def __init__(self, conn, addr, app):
         super().__init__()
         self.app = app
-        self.conn = conn
+        self.conn = SocketConnection(app, conn, addr)
         self.addr = addr
 
     def run(self):
         self.app.log.info("Connection established : " + str(self.addr))
+        self.conn.start()
 
-        while self.app.is_running:
-            self.conn.settimeout(5)
+        framer = LineFramer(self.app.max_query_length)
+        # poll has no limit on descriptor numbers, unlike select, and needs no descriptor of its own
+        poller = select.poll()
+        poller.register(self.conn.sock, select.POLLIN)
+        while self.app.is_running and not self.conn.closed:
             try:
-                data = self.conn.recvfrom(4096)
-            except socket.timeout:
+                readable = poller.poll(5000)
+                data = self.conn.sock.recv(4096) if readable else None
+            except OSError:
+                # Socket was shut down or closed by the writer
+                break
+            if data is None:
                 continue
 
-            if data != (b'', None):
-                string = data[0].decode("utf-8")
-                lines = string.splitlines()
-                for line in lines:
-                    query = line.strip()
-                    self.app.log.debug("Received : " + str(query))
-
-                    if query == 'getCurrentQueue':
-                        self.app.process_get_current_queue(self.conn)
+            if data:
+                for line in framer.feed(data):
+                    self.app.process_line(line, self.addr, self.conn)
+            else:
+                # Last query may come without line break
+                line = framer.flush()
+                if line is not None:
+                    self.app.process_line(line, self.addr, self.conn)
+                self.app.log.info("Connection terminated : " + str(self.addr))
+                break
 
-                    elif query.startswith('getStopInfo?'):
-                        self.app.process_get_stop_info(query, self.addr, self.conn)
+        self.conn.close()
+        self.app.log.debug("Thread for connection ( " + str(self.addr) + " ) terminated")
+        del self.app.listeners[self.addr]
+# -------------------------------------------------------------------------------------------------------------------- #
 
-                    elif query.startswith('getVehiclesInfo?'):
-                        self.app.process_get_vehicles_info(query, self.addr, self.conn)
 
-                    elif query.startswith('getVehiclesInfoWithRegion?'):
-                        self.app.process_get_vehicles_info_with_region(query, self.addr, self.conn)
+class AsyncioConnection(ClientConnection):
+    """
+    Client connection served by asyncio event loop, outbound queue is drained by a writer coroutine.
+    Lets "process_..." handlers and the Executor Thread send data to asyncio connections the same way
+    they do it with plain sockets.
+    """
+    def __init__(self, app, loop, writer):
+        addr = writer.get_extra_info('peername')
+        # Peers of Unix domain sockets are unnamed, give them unique addresses
+        if writer.get_extra_info('socket').family == socket.AF_UNIX:
+            addr = app.make_unix_addr()
+        super().__init__(app, addr)
+        self.loop = loop
+        self.writer = writer
+        self.queue_ready = asyncio.Event()
+
+    def wakeup(self):
+        self.loop.call_soon_threadsafe(self.queue_ready.set)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    async def write_loop(self):
+        """
+        Writer coroutine, sends data from the outbound queue to the client.
+        """
+        try:
+            while True:
+                await self.queue_ready.wait()
+                with self.queue_lock:
+                    self.queue_ready.clear()
+                    if self.closed:
+                        break
+                    messages = self.next_messages()
+                self.writer.writelines(messages)
+                await self.writer.drain()
+        except ConnectionError as e:
+            self.app.log.error("Failed to send data to " + str(self.addr))
+            self.app.log.error("Exception (write_loop):" + str(e))
+            self.close()
 
-                    elif query.startswith('getRouteInfo?'):
-                        self.app.process_get_route_info(query, self.addr, self.conn)
 
-                    elif query.startswith('getLine?'):
-                        self.app.process_get_line(query, self.addr, self.conn)
+class AsyncioServer:
+    """
+    Event loop based server, alternative to thread-per-connection ListenerThread.
+    Speaks exactly the same protocol, all blocking Selenium work stays in the Executor Thread.
+    """
+    def __init__(self, app):
+        self.app = app
+        # Connections currently served by the event loop, {addr: AsyncioConnection}
+        self.connections = {}
 
-                    elif query.startswith('getLayerRegions?'):
-                        self.app.process_get_layer_regions(query, self.addr, self.conn)
+    async def handle_client(self, reader, writer):
+        """
+        Serve one client connection, asyncio counterpart of ListenerThread.run
+        :param reader: asyncio StreamReader
+        :param writer: asyncio StreamWriter
+        :return: nothing
+        """
+        conn = AsyncioConnection(self.app, asyncio.get_running_loop(), writer)
+        addr = conn.addr
+        self.connections[addr] = conn
+        self.app.log.info("Connection established : " + str(addr))
+        write_task = asyncio.create_task(conn.write_loop())
 
-                    elif query.startswith('getAllInfo?'):
-                        self.app.process_get_all_info(query, self.addr, self.conn)
+        framer = LineFramer(self.app.max_query_length)
+        try:
+            while self.app.is_running:
+                data = await reader.read(4096)
+                if not data:
+                    # Last query may come without line break
+                    line = framer.flush()
+                    if line is not None:
+                        self.app.process_line(line, addr, conn)
+                    self.app.log.info("Connection terminated : " + str(addr))
+                    break
+                for line in framer.feed(data):
+                    self.app.process_line(line, addr, conn)
+        except ConnectionError as e:
+            self.app.log.error("Exception (handle_client): " + str(e))
+        finally:
+            del self.connections[addr]
+            conn.close()
+            await write_task
+            writer.close()
+            self.app.log.debug("Handler for connection ( " + str(addr) + " ) terminated")
+
+    async def serve(self, sock, unix_sock=None):
+        """
+        Serve connections accepted on listening socket until the application is stopped.
+        :param sock: bound and listening socket
+        :param unix_sock: bound and listening Unix domain socket, None if not used
+        :return: Application.RESULT_OK
+        """
+        servers = [await asyncio.start_server(self.handle_client, sock=sock)]
+        if unix_sock is not None:
+            servers.append(await asyncio.start_unix_server(self.handle_client, sock=unix_sock))
 
-                    elif query.startswith('getEcho?'):
-                        self.app.process_echo(query, self.addr, self.conn)
+        self.app.log.info("Listening for incoming connections (asyncio).")
+        self.app.log.info("Host: " + str(self.app.host) + " , Port: " + str(self.app.port))
 
-                    else:
-                        self.app.process_unknown_query(self.conn)
-            else:
-                self.app.log.info("Connection terminated : " + str(self.addr))
+        while self.app.is_running:
+            # Checking if Executor Thread is dead.
+            if not self.app.executor_threads_alive():
+                self.app.log.error("Executor thread is dead. Terminating the program.")
+                self.app.is_running = False
                 break
+            await asyncio.sleep(1)
 
-        self.conn.shutdown(socket.SHUT_RDWR)
-        self.app.log.debug("Thread for connection ( " + str(self.addr) + " ) terminated")
-        del self.app.listeners[self.addr]
+        for server in servers:
+            server.close()
+        for conn in list(self.connections.values()):
+            conn.close()
+        for server in servers:
+            await server.wait_closed()
+
+        return self.app.RESULT_OK
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
-class ExecutorThread(threading.Thread):
+class HttpResponseConnection(ClientConnection):
+    """
+    Connection of a single HTTP request. Instead of being serialized, messages are handed over to the HTTP handler,
+    which streams them to the client as chunks.
+    """
+    def __init__(self, app, addr):
+        super().__init__(app, addr)
+        self.messages = queue.Queue()
+
+    def send_messages(self, messages, log_tag=None):
+        if self.closed:
+            return 0
+        for message in messages:
+            self.messages.put(message)
+        return len(messages)
+
+    def wakeup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class HttpGatewayHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 handler, translates "GET /<method>?url=<yandex_url>&id=<id>" requests into regular queries,
+    other query parameters (like "fields") are passed as is.
+    Payload entries are streamed with chunked transfer encoding as JSON lines, connection is kept alive.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # Methods available via HTTP gateway
+    METHODS = ('getStopInfo', 'getVehiclesInfo', 'getVehiclesInfoWithRegion', 'getRouteInfo',
+               'getLine', 'getLayerRegions', 'getAllInfo', 'getEcho')
+
+    def log_message(self, format, *args):  # pylint: disable = W0622
+        self.server.app.log.debug("HTTP " + str(self.client_address) + " : " + (format % args))
+
+    def send_json(self, status, message):
+        """
+        Send complete JSON response with Content-Length
+        :param status: HTTP status code
+        :param message: message (dictionary or list)
+        """
+        body = bytes(json.dumps(message), 'utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        """
+        Write one chunk of chunked transfer encoding
+        :param data: bytes
+        """
+        self.wfile.write(bytes('%x\r\n' % len(data), 'ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def client_disconnected(self):
+        """
+        Check if the HTTP client closed the connection while waiting for the response
+        :return: True if the connection is closed by the client
+        """
+        try:
+            poller = select.poll()
+            poller.register(self.connection, select.POLLIN)
+            return bool(poller.poll(0)) and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def next_message(self, conn):
+        """
+        Wait for next message from the query, executed query may stay in Query Queue for a long time.
+        :param conn: HttpResponseConnection
+        :return: message, None if the server is stopping or the client is gone
+        """
+        while self.server.app.is_running:
+            try:
+                return conn.messages.get(timeout=1)
+            except queue.Empty:
+                if self.client_disconnected():
+                    self.close_connection = True
+                    return None
+        return None
+
+    @staticmethod
+    def make_query(method, query_id, params):
+        """
+        Translate HTTP request to the query line. The query line has no escaping, so "?" is only allowed
+        in the URL, which is the last field.
+        :param method: name of the method
+        :param query_id: ID of the query
+        :param params: dictionary of decoded HTTP query parameters
+        :return: query string
+        """
+        fields = [('id', query_id)] + [(key, params[key]) for key in Application.QUERY_PARAMS if key in params]
+        for key, value in fields:
+            if re.search(r'[?\r\n]', value):
+                raise ValueError('Invalid ' + key + ': "?" and line breaks are not allowed')
+        if re.search(r'[\r\n]', params['url']):
+            raise ValueError('Invalid url: line breaks are not allowed')
+        return method + '?' + ''.join(key + '=' + value + '?' for key, value in fields) + params['url']
+
+    def do_GET(self):  # pylint: disable = C0103
+        """
+        Handle GET request
+        """
+        app = self.server.app
+        path = urlsplit(self.path)
+        method = path.path.strip('/')
+        params = dict(parse_qsl(path.query))
+
+        if method == 'getCurrentQueue':
+            self.send_json(200, json.loads(app.get_current_queue()))
+            return
+
+        if method not in self.METHODS:
+            self.send_json(404, {'response': 'ERROR', 'message': 'Unknown query'})
+            return
+        if 'url' not in params:
+            self.send_json(400, {'response': 'ERROR', 'message': 'Missing "url" parameter'})
+            return
+
+        query_id = params.get('id', 'http-' + str(next(self.server.query_counter)))
+        try:
+            query = self.make_query(method, query_id, params)
+        except ValueError as e:
+            self.send_json(400, {'response': 'ERROR', 'message': str(e)})
+            return
+        conn = HttpResponseConnection(app, self.client_address)
+        app.process_query(query, self.client_address, conn)
+
+        # First message is always an acknowledgment or an error
+        ack = self.next_message(conn)
+        if ack is None:
+            # Queued query of a client which is gone is dropped from the Query Queue
+            conn.close()
+            if not self.close_connection:
+                self.send_json(503, {'response': 'ERROR', 'message': 'Server is stopping'})
+            return
+        if ack.get('response') != 'OK':
+            conn.close()
+            # Server is overloaded, the query may succeed later, other errors are errors of the request
+            self.send_json(503 if ack.get('response') == 'OVERLOADED' else 400, ack)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Query-Id', query_id)
+        self.send_header('X-Queue-Position', str(ack.get('queue_position')))
+        self.send_header('X-Eta', str(ack.get('eta')))
+        self.end_headers()
+
+        try:
+            while True:
+                message = self.next_message(conn)
+                if message is None:
+                    if self.close_connection:
+                        return
+                    break
+                self.write_chunk(bytes(json.dumps(message) + '\n', 'utf-8'))
+                if message.get('expect_more_data', True) is False:
+                    break
+            self.write_chunk(b'')
+        except OSError as e:
+            app.log.error("Exception (HTTP do_GET): " + str(e))
+            self.close_connection = True
+        finally:
+            conn.close()
+
+
+class HttpGatewayServer(ThreadingHTTPServer):
     """
-    Executor thread, single thread to pick and execute queries from Query Queue.
+    HTTP/1.1 keep-alive gateway server, each connection is served by its own thread.
     """
+    daemon_threads = True
+
     def __init__(self, app):
+        self.app = app
+        # Counter to generate query IDs for requests without "id" parameter
+        self.query_counter = itertools.count()
+        super().__init__((app.host, app.http_port), HttpGatewayHandler)
+
+
+class HttpGatewayThread(threading.Thread):
+    """
+    Thread running HTTP gateway alongside the raw TCP protocol
+    """
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self.server = None
+
+    def bind(self):
+        """
+        Bind HTTP gateway socket
+        :return: True if successful, False otherwise
+        """
+        try:
+            self.server = HttpGatewayServer(self.app)
+        except OSError as e:
+            self.app.log.error("Exception (HTTP gateway bind): " + str(e))
+            return False
+        return True
+
+    def run(self):
+        self.app.log.info("HTTP gateway listening on " + str(self.app.host) + ":" + str(self.app.http_port))
+        self.server.serve_forever(poll_interval=1)
+        self.server.server_close()
+        self.app.log.debug("HTTP gateway stopped.")
+
+    def stop(self):
+        """
+        Stop HTTP gateway and wait for the thread to finish
+        """
+        self.server.shutdown()
+        self.join()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+class QueryQueue:
+    """
+    Query Queue ordered by priority class with aging, fair to clients. Rank of a query is its virtual enqueue time
+    plus its priority class times "aging" seconds, so a query of lower class gets ahead of newer queries of higher
+    class after waiting "aging" seconds for each class of difference, and never starves. Queries of the same rank
+    keep FIFO order. Virtual enqueue times of queries of one client are at least "share" seconds apart, so a client
+    with many queued queries gets them interleaved with queries of other clients instead of delaying all of them.
+    Not thread safe, guarded by Application.queue_lock.
+    """
+    PRIORITY_HIGH = 'high'
+    PRIORITY_NORMAL = 'normal'
+    PRIORITY_LOW = 'low'
+    PRIORITIES = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 1, PRIORITY_LOW: 2}
+
+    def __init__(self, aging=60, share=5):
+        # Seconds of waiting which make up for one priority class
+        self.aging = aging
+        # Seconds of Query Queue time each client gets per query
+        self.share = share
+        # Client -> virtual enqueue time of the next query of the client, and number of queued queries of the client,
+        # clients with no queued queries are forgotten
+        self.clocks = {}
+        self.backlogs = defaultdict(int)
+        # Queries in execution order
+        self.queries = []
+        self.counter = itertools.count()
+
+    def rank(self, query):
+        """
+        Get sort key of the query
+        :param query: internal 'query' dictionary
+        :return: tuple, smaller is executed earlier
+        """
+        return query['virtual_time'] + self.PRIORITIES[query['priority']] * self.aging, query['sequence']
+
+    def append(self, query):
+        """
+        Put query into the queue according to its priority class, enqueue time and backlog of its client
+        :param query: internal 'query' dictionary, "priority" is set to normal if missing,
+                      queries without "client" are not subject to fair queuing
+        :return: nothing
+        """
+        query.setdefault('priority', self.PRIORITY_NORMAL)
+        now = time.monotonic()
+        query['enqueue_time'] = now
+        query['virtual_time'] = now
+        client = query.get('client')
+        if client is not None:
+            # Client with empty backlog starts from now, its earlier queries are already served
+            if self.backlogs[client] > 0:
+                query['virtual_time'] = max(now, self.clocks[client])
+            self.clocks[client] = query['virtual_time'] + self.share
+            self.backlogs[client] += 1
+        query['sequence'] = next(self.counter)
+        bisect.insort(self.queries, query, key=self.rank)
+
+    def first_idle(self):
+        """
+        Get first query which is not being executed yet
+        :return: internal 'query' dictionary, None if there is no such query
+        """
+        return next((query for query in self.queries if not query.get('executing')), None)
+
+    def promote(self, query, priority):
+        """
+        Raise priority class of queued query, enqueue time is kept
+        :param query: internal 'query' dictionary, must be in the queue
+        :param priority: new priority class, ignored if not higher than current one
+        :return: nothing
+        """
+        if self.PRIORITIES[priority] >= self.PRIORITIES[query['priority']]:
+            return
+        del self.queries[self.index(query)]
+        query['priority'] = priority
+        bisect.insort(self.queries, query, key=self.rank)
+
+    def index(self, query):
+        """
+        Get position of the query in the queue
+        :param query: internal 'query' dictionary
+        :return: position, raises ValueError if the query is not in the queue
+        """
+        for position, other in enumerate(self.queries):
+            if other is query:
+                return position
+        raise ValueError('query is not in the queue')
+
+    def remove(self, query):
+        """
+        Remove the query from the queue
+        :param query: internal 'query' dictionary
+        :return: nothing, raises ValueError if the query is not in the queue
+        """
+        del self.queries[self.index(query)]
+        self.forget(query)
+
+    def popleft(self):
+        query = self.queries.pop(0)
+        self.forget(query)
+        return query
+
+    def forget(self, query):
+        """
+        Update backlog of the client of the query which left the queue
+        :param query: internal 'query' dictionary
+        :return: nothing
+        """
+        client = query.get('client')
+        if client is None:
+            return
+        self.backlogs[client] -= 1
+        if self.backlogs[client] <= 0:
+            del self.backlogs[client]
+            del self.clocks[client]
+
+    def __getitem__(self, position):
+        return self.queries[position]
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for Yandex page loads. The bucket holds up to "burst" tokens and gets a new token
+    every "interval" seconds, each page load takes one token, so after idle time up to "burst" page loads are done
+    at once, and then not more often than once per "interval" seconds. Thread safe.
+    """
+    def __init__(self, interval, burst=1):
+        # Seconds to refill one token, 0 means no rate limiting
+        self.interval = interval
+        # Maximum number of tokens in the bucket, at least one, or no page would ever be loaded
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take one token from the bucket if there is one
+        :return: 0 if the token is taken, otherwise seconds to wait until the next token is available
+        """
+        with self.lock:
+            if self.interval <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.timestamp) / self.interval)
+            self.timestamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * self.interval
+
+    def wait_time(self):
+        """
+        Get time until a token can be taken, without taking it
+        :return: 0 if there is a token in the bucket, otherwise seconds to wait until the next token is available
+        """
+        with self.lock:
+            if self.interval <= 0:
+                return 0
+            tokens = min(float(self.burst), self.tokens + (time.monotonic() - self.timestamp) / self.interval)
+            return 0 if tokens >= 1 else (1 - tokens) * self.interval
+
+    def available(self):
+        """
+        Check if a token can be taken right away, without taking it
+        :return: True if there is a token in the bucket
+        """
+        return self.wait_time() == 0
+
+    def release(self):
+        """
+        Put back the token taken for a page load which was not done
+        :return: nothing
+        """
+        with self.lock:
+            self.tokens = min(float(self.burst), self.tokens + 1)
+
+    def acquire(self, is_running):
+        """
+        Wait until a token is available and take it
+        :param is_running: function, waiting is aborted when it returns False
+        :return: True if the token is taken, False if waiting was aborted
+        """
+        while is_running():
+            wait_time = self.try_acquire()
+            if wait_time == 0:
+                return True
+            # Waking up at least once a second to check if still running
+            time.sleep(min(wait_time, 1))
+        return False
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+class ResultCache:
+    """
+    Short-lived cache of results of executed queries, indexed by URL and method, so queries for any of the methods
+    loaded with a page are answered without loading it again. Thread safe.
+    """
+    def __init__(self, ttl=10):
+        # Time to keep results, in secs., 0 to disable the cache
+        self.ttl = ttl
+        # (url, method) -> (time of execution, response entries of the method), oldest first
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, url, methods, data):
+        """
+        Store results of single page load
+        :param url: normalized URL
+        :param methods: methods the page was loaded for, all entries are stored under "getAllInfo" if it is one of them
+        :param data: data returned by YandexTransportCore
+        :return: nothing
+        """
+        if self.ttl <= 0 or not data:
+            return
+        now = time.monotonic()
+        results = {}
+        for entry in data:
+            results.setdefault(entry['method'], []).append(entry)
+        if 'getAllInfo' in methods:
+            results['getAllInfo'] = data
+        with self.lock:
+            for method, entries in results.items():
+                self.results.pop((url, method), None)
+                self.results[(url, method)] = (now, entries)
+            # Dropping expired results, they are ordered by time of execution
+            while self.results:
+                key, (timestamp, _) = next(iter(self.results.items()))
+                if now - timestamp <= self.ttl:
+                    break
+                del self.results[key]
+
+    def get(self, url, methods):
+        """
+        Get stored results of all the methods
+        :param url: normalized URL
+        :param methods: methods to get results of
+        :return: response entries of all the methods in YandexTransportCore format, None if any of them is missing
+        """
+        now = time.monotonic()
+        data = []
+        with self.lock:
+            for method in methods:
+                result = self.results.get((url, method))
+                if result is None or now - result[0] > self.ttl:
+                    return None
+                data += result[1]
+        return data
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+class ExecutorThread(threading.Thread):
+    """
+    Executor thread, picks and executes queries from Query Queue. Several Executor Threads, each with its own
+    Yandex Transport API Core, may share the queue, and then share the rate limiter of Yandex page loads.
+    """
+    def __init__(self, app, core, rate_limiter=None):
         super().__init__()
         self.app = app
+        # Yandex Transport API Core
+        self.core = core
 
         # Flag to check if exeturoe thread is running.
         # In case it fails - program should terminate / Executor Thread should restart.
         # Let's stick with "terminate" scenario for now
 
-        # Time to wait between queries
-        self.wait_time = self.app.query_delay
+        # Rate limiter of Yandex page loads, queries answered without loading a page are not limited
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(self.app.query_delay, self.app.query_burst)
+        self.rate_limiter = rate_limiter
         # Time to wait between watch updates
         self.watch_wait_time = 5
 
     def send_message(self, message, addr, conn, log_tag=None):
         """
-        Send a message to the server
-        :param message: message to send
+        Send a message to the client
+        :param message: message to send (dictionary), serialized according to connection framing options
         :param addr: address (from socket bind/accept)
         :param conn: connection
         :param log_tag: tag which will append to log message
         :return: nothing
         """
-        if log_tag is not None:
-            log_tag_text = " (" + log_tag + ")"
-        else:
-            log_tag_text = ""
-        try:
-            send_msg = bytes(str(message) + '\n' + '\0', 'utf-8')
-
-            self.app.log.debug("Writing to " + self.app.network_log_file + " "
-                               "(" + str(len(send_msg)) + " bytes) ")
-            if self.app.network_log_enabled:
-                f = open(self.app.network_log_file, 'ab')
-                f.write(bytes(str(len(send_msg))+'\n', 'utf-8'))
-                f.write(send_msg)
-                f.write(bytes('\n\n', 'utf-8'))
-                f.close()
-
-            self.app.log.debug("Sending response " +
-                               "(" + str(len(send_msg)) + " bytes) "
-                               "to " + str(addr) + log_tag_text)
-
-            # It seems data needs to be sent in chunks, JSON objects with size of several kilobytes
-            # effectively break "sending in one piece" strategy.
-            buffer_size = 4096
-            for chunk in chunks(send_msg, buffer_size):
-                bytes_send = conn.send(chunk)
-                if bytes_send != len(chunk):
-                    self.app.log.error("Sent " + str(bytes_send) + "out of " + str(len(chunk)) + "bytes!")
-
-        except socket.error as e:
+        # Only puts the data to connection outbound queue, actual sending is done by connection writer.
+        if conn.send_message(message, log_tag=log_tag) == 0:
             self.app.log.error("Failed to send data to " + str(addr))
-            self.app.log.error("Exception (send_message):" + str(e))
-    
-    def check_preload_cache(self, url):
+
+    def send_messages(self, messages, addr, conn, log_tag=None):
         """
-        Check if URL is in preload cache and return data if available
-        :param url: URL to check
-        :return: cached data or None
+        Send several messages (all entries of one response) to the client at once
+        :param messages: list of messages to send (dictionaries)
+        :param addr: address (from socket bind/accept)
+        :param conn: connection
+        :param log_tag: tag which will append to log message
+        :return: nothing
         """
-        if self.app.preload_worker:
-            cached_data, cached_error = self.app.preload_worker.get_cached_data(url)
-            if cached_data is not None:
-                # Process cached data into same format as execute_get_info
-                payload = []
-                if cached_error == YandexTransportCore.RESULT_OK:
-                    for entry in cached_data:
-                        if entry.get('error') == 'OK':
-                            payload.append({'method': entry['method'], 'data': entry['data']})
-                        else:
-                            payload.append({'method': entry['method'], 'error': entry.get('error', 'Unknown error')})
-                
-                result = {'code': cached_error, 'payload': payload}
-                return json.dumps(result)
-        return None
-
+        if conn.send_messages(messages, log_tag=log_tag) == 0:
+            self.app.log.error("Failed to send data to " + str(addr))
+    
     def execute_get_info(self, query):
         """
-        Execute general get... query.
+        Execute general get... query, together with queued queries of other methods for the same URL
+        grouped with it.
         :param query: internal 'query' dictionary
         :return: result as JSON
         """
         url = query['body']
+        group = [query] + query.get('group', [])
+        methods = set(member['type'] for member in group)
+        if len(group) > 1:
+            self.app.log.debug("Executing " + str(len(group)) + " queries for " + url + " with single page load")
         
+        # Requesters which got extracted entries already: id of requester -> True if its last entry is sent
+        streamed = {}
+
         # Check preload cache first
+        cached_data = None
         if self.app.preload_worker:
             cached_data, cached_error = self.app.preload_worker.get_cached_data(url)
+            # Cached data is used only if it has entries of all methods of the group
             if cached_data is not None:
-                self.app.log.debug(f"Using preload cache for {url}")
-                data, error = cached_data, cached_error
-            else:
-                # Not in cache, use normal path
-                data, error = self._execute_get_info_normal(query)
+                cached_methods = set(entry['method'] for entry in cached_data)
+                if not methods - {'getAllInfo'} <= cached_methods:
+                    cached_data = None
+        # Then results of recent executions, the page may have been loaded while the query was queued
+        recent_data = None
+        if cached_data is None:
+            recent_data = self.app.result_cache.get(self.app.normalize_url(url), methods)
+
+        # Data loaded for a single method is sent as is, cached data may have entries of other methods
+        filter_data = len(methods) > 1
+        if cached_data is not None:
+            self.app.log.debug(f"Using preload cache for {url}")
+            data, error = cached_data, cached_error
+            filter_data = True
+        elif recent_data is not None:
+            self.app.log.debug("Using results of recent execution for " + url)
+            data, error = recent_data, YandexTransportCore.RESULT_OK
+            filter_data = True
         else:
-            # No preload, use normal path
-            data, error = self._execute_get_info_normal(query)
+            # Not in cache, use normal path, entries are sent to requesters as soon as they are extracted
+            data, error = self._execute_get_info_normal(
+                query, methods, lambda entry, remaining: self.send_extracted_entry(group, methods, url, entry,
+                                                                                   remaining, streamed))
+            if error == YandexTransportCore.RESULT_OK:
+                self.app.result_cache.put(self.app.normalize_url(url), methods, data)
         
-        # Process payload (same for both cached and normal paths)
-        payload = []
-        if error == YandexTransportCore.RESULT_OK:
-            for entry in data:
-                if 'data' in entry:
-                    result = {'id': query['id'],
-                              'method': entry['method'],
-                              'error': self.app.RESULT_OK,
-                              'message': 'OK',
-                              'expect_more_data': True,
-                              'data': entry['data']}
-                    payload.append(result)
+        # Process payload (same for both cached and normal paths),
+        # identical queries attached to each query of the group get the same data
+        for member in group:
+            member_data = data
+            if filter_data and member['type'] != 'getAllInfo' and data:
+                member_data = [entry for entry in data if entry['method'] == member['type']]
+
+            # Requesters dropped while the query was queued get nothing
+            for requester in self.app.live_requesters(member):
+                if streamed.get(id(requester)):
+                    continue
+                if id(requester) in streamed:
+                    # Page load failed after some entries were sent, closing the response with the error
+                    payload = self.app.make_payload(requester['id'], requester['type'], url, [], error,
+                                                    requester.get('fields'))
                 else:
-                    result = {'id': query['id'],
-                              'method': entry['method'],
-                              'error': self.app.RESULT_NO_DATA,
-                              'message': 'No data',
-                              'expect_more_data': True,
-                              }
-                    payload.append(result)
-        elif error == YandexTransportCore.RESULT_GET_ERROR:
-            result = {'id': query['id'],
-                      'method': query['type'],
-                      'error': self.app.RESULT_GET_ERROR,
-                      'message': 'Error getting requested URL',
-                      'expect_more_data': False}
-            payload.append(result)
+                    payload = self.app.make_payload(requester['id'], requester['type'], url, member_data, error,
+                                                    requester.get('fields'))
 
-        if payload:                                   # Same as "if len(payload) > 0:"
-            payload[-1]['expect_more_data'] = False
-        else:
-            result = {'id': query['id'],
-                      'method': query['type'],
-                      'error': self.app.RESULT_NO_YANDEX_DATA,
-                      'message': 'No Yandex Masstransit API data received for method ' + query['type'] +
-                                 ' from URL "' + query['body'] + '"',
-                      'expect_more_data': False}
-            payload.append(result)
+                # Item of getBatch query
+                if 'batch' in requester:
+                    self.app.complete_batch_item(requester['batch'], requester['item'], payload)
 
-        for entry in payload:
-            self.send_message(json.dumps(entry), query['addr'], query['conn'], log_tag=entry['method'])
+                self.send_messages(payload, requester['addr'], requester['conn'], log_tag=requester['type'])
     
-    def _execute_get_info_normal(self, query):
+    def send_extracted_entry(self, group, methods, url, entry, remaining, streamed):
+        """
+        Send entry extracted by Yandex Transport API Core to requesters of the group expecting its method,
+        "expect_more_data" is False if no more entries of their methods are coming.
+        Items of getBatch queries get their entries all at once after the page is loaded.
+        :param group: queries executed with single page load
+        :param methods: set of methods of the queries
+        :param url: URL of the queries
+        :param entry: entry in YandexTransportCore format
+        :param remaining: methods of entries still to be extracted
+        :param streamed: id of requester -> True if its last entry is sent, updated
+        :return: nothing
+        """
+        for member in group:
+            if len(methods) > 1 and member['type'] != 'getAllInfo':
+                if entry['method'] != member['type']:
+                    continue
+                last = member['type'] not in remaining
+            else:
+                last = not remaining
+            for requester in self.app.live_requesters(member):
+                if 'batch' in requester:
+                    continue
+                payload = self.app.make_payload(requester['id'], requester['type'], url, [entry],
+                                                YandexTransportCore.RESULT_OK, requester.get('fields'))
+                payload[-1]['expect_more_data'] = not last
+                streamed[id(requester)] = last
+                self.send_messages(payload, requester['addr'], requester['conn'], log_tag=requester['type'])
+
+    def _execute_get_info_normal(self, query, methods=None, on_entry=None):
         """
         Execute get_info using normal Chrome (non-cached path)
         :param query: internal 'query' dictionary
+        :param methods: set of methods of all queries grouped with this one, None for the query alone
+        :param on_entry: function called with each entry as soon as it is extracted, see YandexTransportCore
         :return: (data, error) tuple
         """
+        # Waiting for the rate limiter before loading the page
+        if not self.rate_limiter.acquire(lambda: self.app.is_running):
+            return None, YandexTransportCore.RESULT_GET_ERROR
+        # Requesters may have gone or got past their deadlines while waiting, the page is loaded only if needed
+        if not self.drop_gone_requesters([query] + query.get('group', [])):
+            self.rate_limiter.release()
+            self.app.log.debug("Query " + str(query['id']) + " dropped, no requesters left")
+            return None, YandexTransportCore.RESULT_GET_ERROR
+
+        started = time.monotonic()
+        try:
+            return self._load_page(query, methods, on_entry)
+        finally:
+            self.app.record_execution_time(time.monotonic() - started)
+
+    def drop_gone_requesters(self, group):
+        """
+        Drop requesters of queries being executed which are past their deadlines or whose connections are closed
+        :param group: queries executed with single page load
+        :return: True if any of the requesters is still waiting for the result
+        """
+        now = time.monotonic()
+        with self.app.queue_lock:
+            expired = []
+            for member in group:
+                for requester in self.app.live_requesters(member):
+                    if requester['conn'].closed:
+                        requester['dropped'] = True
+                    elif (requester.get('deadline') or now) < now:
+                        requester['dropped'] = True
+                        expired.append(requester)
+            live = any(self.app.live_requesters(member) for member in group)
+        for requester in expired:
+            self.send_deadline_exceeded(requester)
+        return live
+
+    def _load_page(self, query, methods, on_entry):
+        """
+        Load the page of the query with Yandex Transport API Core
+        :param query: internal 'query' dictionary
+        :param methods: set of methods of all queries grouped with this one, None for the query alone
+        :param on_entry: function called with each entry as soon as it is extracted, see YandexTransportCore
+        :return: (data, error) tuple
+        """
+        # Several methods for the same URL, single page load for all of them
+        if methods is not None and len(methods) > 1:
+            if 'getAllInfo' in methods:
+                return self.core.get_all_info(url=query['body'], on_entry=on_entry)
+            return self.core.get_methods_info(url=query['body'],
+                                              methods=tuple(method for method in self.app.INFO_METHODS
+                                                            if method in methods),
+                                              on_entry=on_entry)
+
         if query['type'] == 'getStopInfo':
-            return self.app.core.get_stop_info(url=query['body'])
+            return self.core.get_stop_info(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getRouteInfo':
-            return self.app.core.get_route_info(url=query['body'])
+            return self.core.get_route_info(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getLine':
-            return self.app.core.get_line(url=query['body'])
+            return self.core.get_line(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getVehiclesInfo':
-            return self.app.core.get_vehicles_info(url=query['body'])
+            return self.core.get_vehicles_info(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getVehiclesInfoWithRegion':
-            return self.app.core.get_vehicles_info_with_region(url=query['body'])
+            return self.core.get_vehicles_info_with_region(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getLayerRegions':
-            return self.app.core.get_layer_regions(url=query['body'])
+            return self.core.get_layer_regions(url=query['body'], on_entry=on_entry)
         elif query['type'] == 'getAllInfo':
-            return self.app.core.get_all_info(url=query['body'])
+            return self.core.get_all_info(url=query['body'], on_entry=on_entry)
         else:
             return None, YandexTransportCore.RESULT_GET_ERROR
 
+    def send_deadline_exceeded(self, query):
+        """
+        Tell the client that the query was dropped because its deadline has passed
+        :param query: internal 'query' dictionary
+        :return: nothing
+        """
+        self.app.log.debug("Query " + str(query['id']) + " dropped, deadline exceeded")
+        payload = [{'id': query['id'],
+                    'method': query['type'],
+                    'error': self.app.RESULT_DEADLINE_EXCEEDED,
+                    'message': 'Deadline exceeded',
+                    'expect_more_data': False}]
+        if 'batch' in query:
+            self.app.complete_batch_item(query['batch'], query['item'], payload)
+        self.send_messages(payload, query['addr'], query['conn'], log_tag=query['type'])
+
     def execute_get_echo(self, query):
         """
         Execute "getEcho" command.
@@ -293,8 +1361,7 @@ class ExecutorThread(threading.Thread):
                   'message': 'OK',
                   'expect_more_data': False,
                   'data': query['body']}
-        result_json = json.dumps(result)
-        self.send_message(result_json, query['addr'], query['conn'], log_tag='getEcho')
+        self.send_message(result, query['addr'], query['conn'], log_tag='getEcho')
 
     def execute_get_stop_info(self, query):
         """
@@ -412,35 +1479,62 @@ class ExecutorThread(threading.Thread):
         # Default "discard" query
         query = None
 
-        # Get the query from Query Queue
+        # Get the query from Query Queue, skipping queries taken by other Executor Threads.
+        # Queries whose requesters are all past their deadlines are dropped without execution.
+        now = time.monotonic()
+        expired = []
+        wait_time = 0
         self.app.queue_lock.acquire()
-        query_len = len(self.app.query_queue)
-        if query_len > 0:
-            query = self.app.query_queue[0]
+        query = self.app.query_queue.first_idle()
+        while query is not None:
+            expired += self.app.drop_requesters(query, lambda requester: (requester.get('deadline') or now) < now)
+            if self.app.live_requesters(query):
+                break
+            query = self.app.query_queue.first_idle()
+        # Query which may load a page is left in the queue until the rate limiter lets it run,
+        # so meanwhile identical queries are attached to it, and it is dropped if its requesters are gone
+        if query is not None and query['type'] != 'getEcho':
+            wait_time = self.rate_limiter.wait_time()
+            if wait_time > 0:
+                query = None
+        if query is not None:
+            query['executing'] = True
+            # Query is being executed, no more waiters can be attached to it
+            if self.app.pending_queries.get(query.get('key')) is query:
+                del self.app.pending_queries[query['key']]
+                query['group'] = self.app.take_same_url_queries(query)
         self.app.queue_lock.release()
 
+        for requester in expired:
+            self.send_deadline_exceeded(requester)
+
+        if wait_time > 0:
+            time.sleep(min(wait_time, 1))
+            return
+
         # Executing the query
         if query is not None:
             self.execute_query(query)
 
-        # Removing executed query from the Query Queue
+        # Removing executed query from the Query Queue,
+        # queries of higher priority class may have got ahead of it in the meantime
         self.app.queue_lock.acquire()
-        if query_len > 0:
-            self.app.query_queue.popleft()
+        if query is not None:
+            self.app.query_queue.remove(query)
         self.app.queue_lock.release()
 
     def run(self):
-        self.app.log.debug("Executor thread started, wait time between queries is "+str(self.wait_time)+" secs.")
+        self.app.log.debug("Executor thread started, page loads are limited to " +
+                           str(self.rate_limiter.burst) + " per " + str(self.rate_limiter.interval) + " secs.")
         while self.app.is_running:
+            # Waiting for a query, woken up as soon as one is put into Query Queue,
+            # and at least once a second to check if still running
+            with self.app.queue_ready:
+                if self.app.query_queue.first_idle() is None:
+                    self.app.queue_ready.wait(1)
+
             # Extracting and executing extraction and execution of query from Query Queue
             self.perform_query_extraction_and_execution()
-
-            # Waiting for some time before next query is extracted and executed
-            for _ in range(0, self.wait_time):
-                if self.app.is_running:
-                    time.sleep(1)
-                else:
-                    break
         self.app.log.debug("Executor thread stopped.")
 # -------------------------------------------------------------------------------------------------------------------- #
 
@@ -454,9 +1548,16 @@ class PreloadWorker(threading.Thread):
         self.app = app
         self.core = preload_core  # Separate Chrome instance
         self.config = config
-        self.cache = {}  # {url: {'data': [...], 'timestamp': float, 'error': int}}
+        self.cache = {}  # {url: {'data': [...], 'timestamp': float, 'error': int, 'version': int, 'etags': {}}}
+        # Recent versions of cached data, used to answer with delta: {url: deque([(version, data), ...])}
+        self.history = {}
         self.cache_lock = threading.Lock()
         self.is_running = True
+        # Executor of on-demand queries taken from Query Queue with the preload browser between refresh cycles,
+        # used from this thread and never started on its own, None if work stealing is disabled
+        self.executor = None
+        if config.get('work_stealing', False):
+            self.executor = ExecutorThread(app, preload_core, app.rate_limiter)
         
     def get_cached_data(self, url):
         """
@@ -486,7 +1587,48 @@ class PreloadWorker(threading.Thread):
             
             self.app.log.debug(f"Cache hit for {url} (age: {age:.1f}s, stop_id={stop_id})")
             return entry['data'], entry['error']
-    
+
+    def get_cached_entry(self, url, base_version=None):
+        """
+        Get cache entry for URL if fresh enough, together with data of an earlier version
+        :param url: URL to look up
+        :param base_version: earlier version to get data of, None if not needed
+        :return: copy of cache entry with 'base_data' added (None if base version is no longer known),
+                 None if not found/stale
+        """
+        with self.cache_lock:
+            entry = self.cache.get(url)
+            if entry is None or time.time() - entry['timestamp'] > self.config.get('cache_ttl', 120):
+                return None
+
+            base_data = None
+            for version, data in self.history.get(url, ()):
+                if version == base_version:
+                    base_data = data
+            return dict(entry, base_data=base_data)
+
+    @staticmethod
+    def make_etag(data):
+        """
+        Make content hash of "data" of cache entries, other fields (like "url") do not change the hash
+        :param data: list of cache entries
+        :return: hash, hex string
+        """
+        content = json.dumps([entry.get('data') for entry in data], sort_keys=True)
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
+
+    def make_etags(self, data):
+        """
+        Make content hashes of cached data for each method, "getAllInfo" gets hash of all entries
+        :param data: data to cache
+        :return: dictionary {method: hash}
+        """
+        data = data or []
+        etags = {'getAllInfo': self.make_etag(data)}
+        for method in set(entry['method'] for entry in data):
+            etags[method] = self.make_etag([entry for entry in data if entry['method'] == method])
+        return etags
+
     def update_cache(self, url, data, error):
         """
         Update cache entry
@@ -494,6 +1636,7 @@ class PreloadWorker(threading.Thread):
         :param data: Data to cache
         :param error: Error code
         """
+        etags = self.make_etags(data)
         with self.cache_lock:
             # Extract stop ID from data for better logging
             stop_id = "unknown"
@@ -503,12 +1646,29 @@ class PreloadWorker(threading.Thread):
                 if isinstance(inner_data, dict) and 'data' in inner_data:
                     stop_id = inner_data['data'].get('id', 'unknown')
             
+            version = self.cache[url]['version'] + 1 if url in self.cache else 1
             self.cache[url] = {
                 'data': data,
                 'timestamp': time.time(),
-                'error': error
+                'error': error,
+                'version': version,
+                'etags': etags
             }
+            if url not in self.history:
+                self.history[url] = deque(maxlen=self.config.get('delta_history', 10))
+            self.history[url].append((version, data))
             self.app.log.debug(f"Updated cache: URL={url}, stop_id={stop_id}, items={len(data) if data else 0}")
+
+        # Push new data to subscribers, outside of cache lock
+        self.app.publish_update(url, data, error)
+
+    def is_watched(self, url):
+        """
+        Check if URL is in the list of watched stops
+        :param url: URL to check
+        :return: True if the URL is refreshed by this worker
+        """
+        return any(stop['url'] == url for stop in self.config['stops'])
     
     def preload_stop(self, stop):
         """
@@ -786,6 +1946,37 @@ class PreloadWorker(threading.Thread):
         return results
 
     
+    def can_steal_work(self, remaining):
+        """
+        Check if an on-demand query should be taken from Query Queue now. Refresh cycles have priority,
+        so the query is taken only if average page load fits in the time left before the next cycle,
+        and page load rate limit allows loading the page right away.
+        :param remaining: time left before the next refresh cycle, in secs.
+        :return: True if the query should be taken
+        """
+        with self.app.queue_lock:
+            if self.app.query_queue.first_idle() is None:
+                return False
+        return remaining > (self.app.execution_time or 0) and self.executor.rate_limiter.available()
+
+    def wait_for_next_cycle(self, next_cycle):
+        """
+        Wait until the next refresh cycle is due, executing queued on-demand queries with the preload browser
+        meanwhile if work stealing is enabled
+        :param next_cycle: time of the next refresh cycle, time.monotonic() based
+        :return: nothing
+        """
+        while self.is_running and self.app.is_running:
+            remaining = next_cycle - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.executor is not None and self.can_steal_work(remaining):
+                # Pages of on-demand queries are loaded in the main tab, tabs of watched stops are kept
+                self.core.switch_to_main_tab()
+                self.executor.perform_query_extraction_and_execution()
+                continue
+            time.sleep(min(remaining, 1))
+
     def run(self):
         """
         Main preload loop
@@ -810,9 +2001,9 @@ class PreloadWorker(threading.Thread):
             except Exception as e:
                 self.app.log.debug(f"Error clearing performance logs: {e}")
             
-            # Sleep before next refresh cycle
+            # Sleep before next refresh cycle, executing on-demand queries meanwhile if work stealing is enabled
             if self.is_running and self.app.is_running:
-                time.sleep(self.config['refresh_interval'])
+                self.wait_for_next_cycle(time.monotonic() + self.config['refresh_interval'])
         
         self.app.log.info("PreloadWorker thread terminated")
 
@@ -829,9 +2020,40 @@ class Application:
     RESULT_NO_DATA = 1
     RESULT_GET_ERROR = 2
     RESULT_NO_YANDEX_DATA = 3
+    RESULT_NOT_MODIFIED = 4
+    RESULT_DEADLINE_EXCEEDED = 5
 
     RESULT_SOCKET_BIND_FAILED = 1
 
+    # Optional "key=value" parameters of get... queries, placed between query ID and URL
+    QUERY_PARAMS = ('fields', 'since', 'delta', 'ifNoneMatch', 'priority', 'deadline')
+
+    # Formats of delta responses: JSON Patch (RFC 6902) and JSON Merge Patch (RFC 7386)
+    DELTA_FORMATS = ('patch', 'merge')
+
+    # Named sets of JSON paths for "fields" query parameter
+    FIELD_PRESETS = {
+        'arrivals': ('data.properties.name',
+                     'data.properties.StopMetaData.id',
+                     'data.properties.StopMetaData.Transport.*.id',
+                     'data.properties.StopMetaData.Transport.*.name',
+                     'data.properties.StopMetaData.Transport.*.type',
+                     'data.properties.StopMetaData.Transport.*.EstimatedArrivals',
+                     'data.properties.StopMetaData.Transport.*.BriefSchedule'),
+        'vehicles': ('data.properties.VehicleMetaData.Vehicles.*.id',
+                     'data.properties.VehicleMetaData.Vehicles.*.coordinates',
+                     'data.properties.VehicleMetaData.Vehicles.*.ThreadMetaData'),
+        'route': ('data.name',
+                  'data.properties.RouteMetaData'),
+    }
+
+    # Yandex Masstransit API methods, getAllInfo gets all of them at once
+    INFO_METHODS = ('getStopInfo', 'getVehiclesInfo', 'getVehiclesInfoWithRegion', 'getRouteInfo',
+                    'getLine', 'getLayerRegions')
+
+    # Methods allowed in getBatch query
+    BATCH_METHODS = INFO_METHODS + ('getAllInfo',)
+
     def __init__(self):
         setproctitle.setproctitle('transport_proxy')
 
@@ -842,14 +2064,49 @@ class Application:
         # Listen port
         self.port = 25555
 
-        # Delay between queries, in secs.
+        # Delay between Yandex page loads, in secs., after idle time up to query_burst pages are loaded at once
         self.query_delay = 5
+        self.query_burst = 1
 
-        # Yandex Transport API Core
-        self.core = None
+        # Serve connections with asyncio event loop instead of thread per connection
+        self.use_asyncio = False
+
+        # Size of the queue of pending connections
+        self.backlog = socket.SOMAXCONN
+
+        # Path of Unix domain socket to listen on in addition to TCP, disabled if None
+        self.unix_socket = None
+        self.unix_connection_counter = itertools.count(1)
+
+        # HTTP gateway port, HTTP gateway is disabled if 0
+        self.http_port = 0
+        self.http_gateway = None
+
+        # Maximum length of single query line, in bytes
+        self.max_query_length = 65536
 
-        # Executor thread
-        self.executor_thread = None
+        # Maximum size of per-connection outbound queue, in bytes, and what to do if it overflows
+        self.send_queue_size = 4 * 1024 * 1024
+        self.send_queue_policy = ClientConnection.POLICY_DISCONNECT
+
+        # Number of Executor Threads, each with its own Yandex Transport API Core
+        self.workers = 1
+
+        # Results of recent executions, to answer queries for the same URL without loading the page again
+        self.result_cache = ResultCache()
+
+        # Maximum number of queries in Query Queue, new queries are rejected as overloaded above it, 0 for no limit
+        self.max_queue = 0
+        # Maximum number of queued queries of one client, including attached ones, 0 for no limit
+        self.max_client_queries = 0
+        # Moving average of Yandex page load time, in secs., None until the first page is loaded
+        self.execution_time = None
+        # Weight of the latest page load time in the moving average
+        self.execution_time_weight = 0.2
+        # Executor threads, their cores and rate limiter of Yandex page loads shared by all of them
+        self.executor_threads = []
+        self.cores = []
+        self.rate_limiter = None
 
         # List of clients currently connected to the server
         self.listeners = defaultdict()
@@ -863,6 +2120,8 @@ class Application:
 
         # Queue lock
         self.queue_lock = threading.Lock()
+        # Notified when a query is put into Query Queue
+        self.queue_ready = threading.Condition(self.queue_lock)
 
         # Will turn on with "Watch" command, and prevent any further queries to be added to Queue
         self.watch_lock = False
@@ -870,8 +2129,15 @@ class Application:
         # Last Query ID, will increment with each query added to the Queue
         self.query_id = 0
 
-        # Server will run in single thread, the deque is to store incoming queries.
-        self.query_queue = deque()
+        # Server will run in single thread, the queue is to store incoming queries, ordered by priority.
+        self.query_queue = QueryQueue()
+        # Queued get... queries not being executed yet, identical queries are attached to them,
+        # {(query_type, normalized_url): query}
+        self.pending_queries = {}
+
+        # Push subscriptions to watched stops, {url: {conn: subscription_id}}
+        self.subscriptions = defaultdict(dict)
+        self.subscriptions_lock = threading.Lock()
         
         # Preload cache configuration
         self.preload_config = None
@@ -910,48 +2176,157 @@ class Application:
         for key, listener in copy_listeners.items():
             listener.join()
         # pylint: enable = W0612
-        if self.executor_thread is not None:
-            self.executor_thread.join()
+        for executor_thread in self.executor_threads:
+            executor_thread.join()
+
+    def executor_threads_alive(self):
+        """
+        Check if all Executor Threads are running
+        :return: True if all of them are alive
+        """
+        return all(executor_thread.is_alive() for executor_thread in self.executor_threads)
 
     def listen(self):
         """
         Start listening to incoming connections. Each new accepted connection will create a new ListenerThread.
         :return: nothing
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
         self.log.debug("Binding socket...")
         try:
-            sock.bind((self.host, self.port))
+            sock = self.make_listen_socket(self.host, self.port, self.backlog)
         except socket.error as e:
             self.log.error("Exception (listen): " + str(e))
             return self.RESULT_SOCKET_BIND_FAILED
 
+        unix_sock = None
+        if self.unix_socket is not None:
+            try:
+                unix_sock = self.make_unix_listen_socket(self.unix_socket, self.backlog)
+            except socket.error as e:
+                self.log.error("Exception (listen): " + str(e))
+                sock.close()
+                return self.RESULT_SOCKET_BIND_FAILED
+
+        if self.use_asyncio:
+            try:
+                return asyncio.run(AsyncioServer(self).serve(sock, unix_sock))
+            finally:
+                self.remove_unix_socket()
+
         self.log.info("Listening for incoming connections.")
         self.log.info("Host: " + str(self.host) + " , Port: " + str(self.port))
-        sock.listen(1)
+        listen_sockets = [sock]
+        if unix_sock is not None:
+            self.log.info("Unix socket: " + self.unix_socket)
+            listen_sockets.append(unix_sock)
+        poller = select.poll()
+        for listen_sock in listen_sockets:
+            poller.register(listen_sock, select.POLLIN)
+        listen_fds = {listen_sock.fileno(): listen_sock for listen_sock in listen_sockets}
 
         while self.is_running:
             # Checking if Executor Thread is dead.
-            if not self.executor_thread.is_alive():
+            if not self.executor_threads_alive():
                 self.log.error("Executor thread is dead. Terminating the program.")
                 self.is_running = False
                 break
 
-            try:
-                conn, addr = sock.accept()
-            except socket.timeout:
-                continue
+            for fd, _ in poller.poll(5000):
+                listen_sock = listen_fds[fd]
+                try:
+                    conn, addr = listen_sock.accept()
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    # Out of descriptors, pending connections wait in the backlog until some are closed
+                    self.log.error("Exception (listen): " + str(e))
+                    time.sleep(0.1)
+                    continue
+                if listen_sock is unix_sock:
+                    addr = self.make_unix_addr()
+                self.accept_connection(conn, addr)
 
+        for listen_sock in listen_sockets:
+            listen_sock.close()
+        self.remove_unix_socket()
 
-            listener_thread = ListenerThread(conn, addr, self)
-            self.listeners[addr] = listener_thread
-            listener_thread.start()
+        return self.RESULT_OK
+
+    @staticmethod
+    def make_listen_socket(host, port, backlog):
+        """
+        Create, bind and listen TCP socket
+        :param host: host to listen on
+        :param port: port to listen on
+        :param backlog: size of the queue of pending connections
+        :return: listening socket, raises socket.error if binding failed
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+            sock.listen(backlog)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
 
-        sock.shutdown(socket.SHUT_RDWR)
+    @staticmethod
+    def make_unix_listen_socket(path, backlog):
+        """
+        Create, bind and listen Unix domain socket. Stale socket file left by previous run is removed,
+        any other file, or socket some server still listens on, is left as is.
+        :param path: path of the socket file
+        :param backlog: size of the queue of pending connections
+        :return: listening socket, raises socket.error if binding failed
+        """
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise socket.error(path + " exists and is not a socket")
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                # Nobody listens on the socket, left by previous run
+                os.unlink(path)
+            else:
+                raise socket.error(path + " is in use by another server")
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(path)
+            sock.listen(backlog)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def remove_unix_socket(self):
+        """
+        Remove Unix domain socket file
+        :return: nothing
+        """
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
 
-        return self.RESULT_OK
+    def make_unix_addr(self):
+        """
+        Make unique address for a client connected to Unix domain socket, clients of Unix domain sockets are unnamed
+        :return: address in the same form as TCP address, ("unix:<path>", <connection number>)
+        """
+        return 'unix:' + str(self.unix_socket), next(self.unix_connection_counter)
+
+    def accept_connection(self, conn, addr):
+        """
+        Start serving accepted connection with new ListenerThread.
+        :param conn: connected socket
+        :param addr: address (from socket accept)
+        :return: nothing
+        """
+        listener_thread = ListenerThread(conn, addr, self)
+        self.listeners[addr] = listener_thread
+        listener_thread.start()
 
     def get_current_connections(self):
         """
@@ -975,16 +2350,23 @@ class Application:
         """
         Get current Query Queue.
         :return: JSON containing list of elements in Query Queue
-                 {"type": "string", "id": "string", "query": "string"}
-                   type  - type of query (get_stop_info, get_vehicles_info etc.)
-                   id    - ID of query, string value, passed from the client.
-                   query - actual query string
+                 {"type": "string", "id": "string", "query": "string", "priority": "string", "waiters": "integer",
+                  "client": "string"}
+                   type     - type of query (get_stop_info, get_vehicles_info etc.)
+                   id       - ID of query, string value, passed from the client.
+                   query    - actual query string
+                   priority - priority class of query (high, normal, low)
+                   waiters  - number of identical queries attached to this one
+                   client   - identity of the client, used for fair queuing
+                 Queries are listed in the order of execution.
         """
         data = []
 
         self.queue_lock.acquire()
         for entry in self.query_queue:
-            entry = {'type': entry['type'], 'id': entry['id'], 'query': entry['body']}
+            entry = {'type': entry['type'], 'id': entry['id'], 'query': entry['body'],
+                     'priority': entry['priority'], 'waiters': len(entry.get('waiters', [])),
+                     'client': entry.get('client')}
             data.append(entry)
         self.queue_lock.release()
 
@@ -992,6 +2374,298 @@ class Application:
 
         return json_data
 
+    def get_cached_payload(self, query_id, query_type, url, params=None):
+        """
+        Get response entries for the query from preload cache. Entries have "version" of cached data and "etag",
+        hash of the data returned for the method of the query,
+        if "since" parameter is set and data of that version is still known "data" is replaced with "delta",
+        if "ifNoneMatch" parameter matches "etag" single "Not modified" entry is returned.
+        URLs not in preload cache are looked up in results of recent executions.
+        :param query_id: ID of the query
+        :param query_type: type of the query (getStopInfo, getLine etc.)
+        :param url: URL of the query
+        :param params: query parameters, as returned by parse_query_params
+        :return: list of response entries, None if the query can't be answered from cache
+        """
+        if query_type == 'getEcho':
+            return None
+        params = params or {}
+        cached = None
+        if self.preload_worker is not None:
+            cached = self.preload_worker.get_cached_entry(url, params.get('since'))
+        if cached is None or cached['data'] is None or cached['error'] != YandexTransportCore.RESULT_OK:
+            return self.get_recent_payload(query_id, query_type, url, params)
+        data = cached['data']
+        base_data = cached['base_data']
+        # getAllInfo gets everything cached for the URL, other queries only the entries of their method
+        if query_type != 'getAllInfo':
+            data = [entry for entry in data if entry['method'] == query_type]
+            if not data:
+                return self.get_recent_payload(query_id, query_type, url, params)
+
+        etag = cached['etags'][query_type]
+        if params.get('ifNoneMatch') == etag:
+            return [{'id': query_id,
+                     'method': query_type,
+                     'error': self.RESULT_NOT_MODIFIED,
+                     'message': 'Not modified',
+                     'expect_more_data': False,
+                     'version': cached['version'],
+                     'etag': etag}]
+
+        payload = self.make_payload(query_id, query_type, url, data, cached['error'], params.get('fields'))
+        for entry in payload:
+            entry['version'] = cached['version']
+            entry['etag'] = etag
+
+        if params.get('since') is not None:
+            if base_data is None:
+                self.log.debug("Version " + str(params['since']) + " of " + url + " is unknown, sending full data")
+            else:
+                if query_type != 'getAllInfo':
+                    base_data = [entry for entry in base_data if entry['method'] == query_type]
+                base_payload = self.make_payload(query_id, query_type, url, base_data,
+                                                 YandexTransportCore.RESULT_OK, params.get('fields'))
+                self.make_delta(payload, base_payload, params['since'], params.get('delta', 'patch'))
+        return payload
+
+    def get_recent_payload(self, query_id, query_type, url, params):
+        """
+        Get response entries for the query from results of recent executions, which have no version,
+        so "since" and "ifNoneMatch" parameters are ignored.
+        :param query_id: ID of the query
+        :param query_type: type of the query (getStopInfo, getLine etc.)
+        :param url: URL of the query
+        :param params: query parameters, as returned by parse_query_params
+        :return: list of response entries, None if there are no recent results for the query
+        """
+        data = self.result_cache.get(self.normalize_url(url), (query_type,))
+        if data is None:
+            return None
+        return self.make_payload(query_id, query_type, url, data, YandexTransportCore.RESULT_OK, params.get('fields'))
+
+    def make_delta(self, payload, base_payload, base_version, delta_format):
+        """
+        Replace "data" of response entries with delta against the same entries of earlier version.
+        Entries without matching earlier entry keep full data.
+        :param payload: list of response entries
+        :param base_payload: list of response entries of earlier version
+        :param base_version: earlier version
+        :param delta_format: "patch" for JSON Patch, "merge" for JSON Merge Patch
+        :return: nothing
+        """
+        for entry, base_entry in zip(payload, base_payload):
+            if 'data' not in entry or 'data' not in base_entry or entry['method'] != base_entry['method']:
+                continue
+            data = entry.pop('data')
+            if delta_format == 'merge':
+                entry['delta'] = self.make_merge_patch(base_entry['data'], data)
+            else:
+                entry['delta'] = self.make_json_patch(base_entry['data'], data)
+            entry['base_version'] = base_version
+
+    @classmethod
+    def make_json_patch(cls, base, value, path=''):
+        """
+        Make JSON Patch (RFC 6902) turning base value into new value. Lists of different length are replaced whole.
+        :param base: base JSON value
+        :param value: new JSON value
+        :param path: JSON Pointer of the values
+        :return: list of patch operations, empty if values are equal
+        """
+        if isinstance(base, dict) and isinstance(value, dict):
+            patch = []
+            for key in base:
+                if key not in value:
+                    patch.append({'op': 'remove', 'path': path + '/' + cls.escape_pointer(key)})
+            for key, item in value.items():
+                item_path = path + '/' + cls.escape_pointer(key)
+                if key in base:
+                    patch.extend(cls.make_json_patch(base[key], item, item_path))
+                else:
+                    patch.append({'op': 'add', 'path': item_path, 'value': item})
+            return patch
+
+        if isinstance(base, list) and isinstance(value, list) and len(base) == len(value):
+            patch = []
+            for index, (base_item, item) in enumerate(zip(base, value)):
+                patch.extend(cls.make_json_patch(base_item, item, path + '/' + str(index)))
+            return patch
+
+        if type(base) is type(value) and base == value:
+            return []
+        return [{'op': 'replace', 'path': path, 'value': value}]
+
+    @staticmethod
+    def escape_pointer(key):
+        """
+        Escape key for JSON Pointer (RFC 6901)
+        :param key: dictionary key
+        :return: escaped key
+        """
+        return str(key).replace('~', '~0').replace('/', '~1')
+
+    @classmethod
+    def make_merge_patch(cls, base, value):
+        """
+        Make JSON Merge Patch (RFC 7386) turning base value into new value, only changed subtrees are included.
+        :param base: base JSON value
+        :param value: new JSON value
+        :return: merge patch, empty dictionary if values are equal
+        """
+        if not isinstance(base, dict) or not isinstance(value, dict):
+            return value
+        patch = {}
+        for key in base:
+            if key not in value:
+                patch[key] = None
+        for key, item in value.items():
+            if key not in base:
+                patch[key] = item
+            elif type(base[key]) is not type(item) or base[key] != item:
+                patch[key] = cls.make_merge_patch(base[key], item)
+        return patch
+
+    def make_payload(self, query_id, query_type, url, data, error, fields=None):
+        """
+        Make list of response entries from YandexTransportCore results
+        :param query_id: ID of the query
+        :param query_type: type of the query (getStopInfo, getLine etc.)
+        :param url: URL of the query
+        :param data: data returned by YandexTransportCore (or from preload cache)
+        :param error: error code returned by YandexTransportCore
+        :param fields: JSON paths to keep in "data", as returned by parse_fields, None to keep everything
+        :return: list of response entries, last one has "expect_more_data" set to False
+        """
+        payload = []
+        if error == YandexTransportCore.RESULT_OK:
+            for entry in data:
+                if 'data' in entry:
+                    result = {'id': query_id,
+                              'method': entry['method'],
+                              'error': self.RESULT_OK,
+                              'message': 'OK',
+                              'expect_more_data': True,
+                              'data': entry['data'] if fields is None else self.project(entry['data'], fields)}
+                    payload.append(result)
+                else:
+                    result = {'id': query_id,
+                              'method': entry['method'],
+                              'error': self.RESULT_NO_DATA,
+                              'message': 'No data',
+                              'expect_more_data': True,
+                              }
+                    payload.append(result)
+        elif error == YandexTransportCore.RESULT_GET_ERROR:
+            result = {'id': query_id,
+                      'method': query_type,
+                      'error': self.RESULT_GET_ERROR,
+                      'message': 'Error getting requested URL',
+                      'expect_more_data': False}
+            payload.append(result)
+
+        if payload:                                   # Same as "if len(payload) > 0:"
+            payload[-1]['expect_more_data'] = False
+        else:
+            result = {'id': query_id,
+                      'method': query_type,
+                      'error': self.RESULT_NO_YANDEX_DATA,
+                      'message': 'No Yandex Masstransit API data received for method ' + query_type +
+                                 ' from URL "' + url + '"',
+                      'expect_more_data': False}
+            payload.append(result)
+
+        return payload
+
+    @classmethod
+    def parse_fields(cls, fields):
+        """
+        Parse "fields" query parameter: name of a preset from FIELD_PRESETS or comma separated
+        list of dot separated JSON paths, "*" matches every key or list item.
+        :param fields: value of "fields" parameter, None if not set
+        :return: list of paths, each path is a list of keys, None if not set
+        """
+        if fields is None:
+            return None
+        paths = cls.FIELD_PRESETS.get(fields, fields.split(','))
+        result = []
+        for path in paths:
+            keys = path.strip().split('.')
+            if '' in keys:
+                raise ValueError('Invalid fields: "' + fields + '"')
+            result.append(keys)
+        return result
+
+    @classmethod
+    def project(cls, value, paths):
+        """
+        Keep only parts of JSON value matching given paths, structure of the value is preserved
+        :param value: JSON value (dict, list or scalar)
+        :param paths: list of paths, as returned by parse_fields
+        :return: projected value
+        """
+        if [] in paths:
+            return value
+        if isinstance(value, dict):
+            items = value.items()
+            result = {}
+        elif isinstance(value, list):
+            items = enumerate(value)
+            result = []
+        else:
+            return None
+
+        for key, item in items:
+            item_paths = [path[1:] for path in paths if path[0] in ('*', str(key))]
+            # Paths going deeper than the value are skipped
+            if not item_paths or (not isinstance(item, (dict, list)) and [] not in item_paths):
+                continue
+            if isinstance(result, dict):
+                result[key] = cls.project(item, item_paths)
+            else:
+                result.append(cls.project(item, item_paths))
+        return result
+
+    def connection_closed(self, conn):
+        """
+        Forget everything related to closed connection
+        :param conn: connection
+        :return: nothing
+        """
+        with self.subscriptions_lock:
+            for url in list(self.subscriptions):
+                self.subscriptions[url].pop(conn, None)
+                if not self.subscriptions[url]:
+                    del self.subscriptions[url]
+
+        # Queued queries of the connection are not executed, queries being executed are finished,
+        # their results are discarded
+        self.queue_lock.acquire()
+        for query in list(self.query_queue):
+            if not query.get('executing'):
+                self.drop_requesters(query, lambda requester: requester['conn'] is conn)
+        self.queue_lock.release()
+
+    def publish_update(self, url, data, error):
+        """
+        Push fresh preload cache data to all connections subscribed to the URL
+        :param url: URL of the watched stop
+        :param data: data returned by YandexTransportCore
+        :param error: error code returned by YandexTransportCore
+        :return: nothing
+        """
+        with self.subscriptions_lock:
+            subscribers = list(self.subscriptions.get(url, {}).items())
+        if not subscribers:
+            return
+
+        payload = self.make_payload(None, 'subscribeStop', url, data, error)
+        for entry in payload:
+            entry['subscription'] = url
+        self.log.debug("Pushing update for " + url + " to " + str(len(subscribers)) + " subscribers")
+        for conn, subscription_id in subscribers:
+            conn.send_messages([dict(entry, id=subscription_id) for entry in payload], log_tag='subscribeStop')
+
     def handle_watch_lock(self, conn):
         """
         Send a message back to the client if new query arrived while WatchLock is engaged.
@@ -1005,8 +2679,57 @@ class Application:
                         "response": "ERROR",
                         "message": "Watch task is planned, no queries accepted until cancelled!",
                        }
-            response_json = json.dumps(response)
-            conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+            conn.send_message(response)
+
+    @classmethod
+    def split_query_params(cls, query_body):
+        """
+        Get optional parameters from body of get... query: key=value?key=value?...?URL
+        :param query_body: body of the query, as returned by split_query
+        :return: dictionary of parameters, the rest of the body (URL)
+        """
+        params = {}
+        while True:
+            result = re.match(r'(\w+)=([^?]*)\?(.*)', query_body)
+            if result is None or result.group(1) not in cls.QUERY_PARAMS:
+                break
+            params[result.group(1)] = result.group(2)
+            query_body = result.group(3)
+        return params, query_body
+
+    def parse_query_params(self, query_id, query_body, conn):
+        """
+        Get and validate optional parameters of get... query, error is sent to the client if they are invalid
+        :param query_id: ID of the query
+        :param query_body: body of the query, as returned by split_query
+        :param conn: connection
+        :return: dictionary of parsed parameters and the rest of the body, None and None if parameters are invalid
+        """
+        params, query_body = self.split_query_params(query_body)
+        try:
+            params['fields'] = self.parse_fields(params.get('fields'))
+            if 'since' in params:
+                if not params['since'].isdigit():
+                    raise ValueError('Invalid since: "' + params['since'] + '"')
+                params['since'] = int(params['since'])
+            if params.get('delta', 'patch') not in self.DELTA_FORMATS:
+                raise ValueError('Invalid delta: "' + params['delta'] + '"')
+            if params.setdefault('priority', conn.priority) not in QueryQueue.PRIORITIES:
+                raise ValueError('Invalid priority: "' + params['priority'] + '"')
+            if 'deadline' in params:
+                # Seconds from now, converted to monotonic time
+                try:
+                    deadline = float(params['deadline'])
+                except ValueError:
+                    deadline = 0
+                if not deadline > 0:
+                    raise ValueError('Invalid deadline: "' + params['deadline'] + '"')
+                params['deadline'] = time.monotonic() + deadline
+        except ValueError as e:
+            response = {'id': query_id, 'response': 'ERROR', 'message': str(e)}
+            conn.send_message(response)
+            return None, None
+        return params, query_body
 
     @staticmethod
     def split_query(query):
@@ -1039,50 +2762,413 @@ class Application:
                 self.watch_lock = True
 
             query_type, query_id, query_body = self.split_query(query)
-            
-            # FAST PATH: Check preload cache BEFORE putting into queue
-            # This avoids blocking cached requests behind slow non-cached requests
-            if self.preload_worker and self.executor_thread and query_type == 'getStopInfo':
-                cached_data = self.executor_thread.check_preload_cache(query_body)
-                if cached_data:
-                    # Send cached response immediately without queueing
-                    self.log.debug(f"Fast path: serving {query_id} from cache without queueing")
-                    response = {'id': query_id,
-                                'response': 'OK',
-                                'queue_position': -1}  # -1 indicates cache hit
-                    response_json = json.dumps(response)
-                    conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
-                    
-                    # Parse and send actual data entries
-                    try:
-                        result = json.loads(cached_data)
-                        payload = result.get('payload', [])
-                        if payload:
-                            payload[-1]['expect_more_data'] = False
-                        for entry in payload:
-                            entry_json = json.dumps(entry)
-                            self.log.debug("Sending (fast path): " + entry_json)
-                            conn.send(bytes(entry_json + '\n' + '\0', 'utf-8'))
-                    except Exception as e:
-                        self.log.error(f"Fast path error sending data: {e}")
+            # getEcho body is echoed as is
+            params = {'fields': None, 'priority': conn.priority}
+            if query_type != 'getEcho':
+                params, query_body = self.parse_query_params(query_id, query_body, conn)
+                if params is None:
                     return
 
+            if not self.register_inflight(query_id, conn):
+                return
+
+            # FAST PATH: Check preload cache BEFORE putting into queue
+            # This avoids blocking cached requests behind slow non-cached requests,
+            # cache hit responses may overtake queries queued earlier on the same connection.
+            payload = self.get_cached_payload(query_id, query_type, query_body, params)
+            if payload is not None:
+                # Send cached response immediately without queueing
+                self.log.debug(f"Fast path: serving {query_id} from cache without queueing")
+                response = {'id': query_id,
+                            'response': 'OK',
+                            'queue_position': -1,  # -1 indicates cache hit
+                            'eta': 0}
+                conn.send_message(response)
+
+                # Send actual data entries
+                conn.send_messages(payload, log_tag='fast path')
+                return
+
             # SLOW PATH: Put into queue for normal processing
             self.queue_lock.acquire()
-            self.query_queue.append({'type': query_type,
-                                     'id': query_id,
-                                     'body': query_body,
-                                     'addr': addr,
-                                     'conn': conn}
-                                   )
-            queue_position = len(self.query_queue) - 1
+            query = {'type': query_type,
+                     'id': query_id,
+                     'body': query_body,
+                     'fields': params['fields'],
+                     'priority': params['priority'],
+                     'deadline': params.get('deadline'),
+                     'addr': addr,
+                     'conn': conn,
+                     'client': conn.get_client_id()}
+            queue_position = self.enqueue_get_info(query)
+            if queue_position is None:
+                response = self.make_overloaded_response(query_id, query['rejected'])
+                self.queue_lock.release()
+                conn.inflight.discard(query_id)
+                conn.send_message(response)
+                return
+
+            # Acknowledgment is queued before the lock is released, so it is sent before any data of the query
+            response = {'id': query_id,
+                        'response': 'OK',
+                        'queue_position': queue_position,
+                        'eta': self.estimate_start(queue_position)}
+            conn.send_message(response)
             self.queue_lock.release()
 
+    @staticmethod
+    def normalize_url(url):
+        """
+        Normalize URL to compare queries: scheme and host are lowercased, fragment is dropped,
+        query string parameters are sorted.
+        :param url: URL
+        :return: normalized URL
+        """
+        parts = urlsplit(url.strip())
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+    def enqueue_get_info(self, query):
+        """
+        Put get... query into Query Queue, should be called with queue_lock acquired.
+        If identical query (same method and URL) is already waiting in the queue, the new query is attached
+        to it as a waiter, and gets the result of the same execution. getEcho queries are always queued.
+        :param query: internal 'query' dictionary
+        :return: position of the query in Query Queue, None if the query is rejected, then query['rejected']
+                 is the reason
+        """
+        # Waking up Executor Thread
+        self.queue_ready.notify()
+
+        pending = None
+        if query['type'] != 'getEcho':
+            query['key'] = (query['type'], self.normalize_url(query['body']))
+            pending = self.pending_queries.get(query['key'])
+        # Attached queries add no load, they are accepted even if Query Queue is full
+        query['rejected'] = self.get_rejection_reason(query['client'], attached=pending is not None)
+        if query['rejected'] is not None:
+            return None
+
+        if query['type'] == 'getEcho':
+            self.query_queue.append(query)
+            return self.query_queue.index(query)
+
+        if pending is not None:
+            pending['waiters'].append(query)
+            # Queued query is executed as soon as the most urgent of its requesters needs
+            self.query_queue.promote(pending, query['priority'])
+            self.log.debug("Query " + str(query['id']) + " attached to queued query " + str(pending['id']))
+            return self.query_queue.index(pending)
+
+        query['waiters'] = []
+        self.query_queue.append(query)
+        self.pending_queries[query['key']] = query
+        return self.query_queue.index(query)
+
+    def queue_full(self, count=1):
+        """
+        Check if Query Queue has no room for more queries, should be called with queue_lock acquired
+        :param count: number of queries to be put into the queue
+        :return: True if the queries must be rejected
+        """
+        return 0 < self.max_queue < len(self.query_queue) + count
+
+    def client_queue_full(self, client, count=1):
+        """
+        Check if the client has too many queued queries, should be called with queue_lock acquired
+        :param client: client identity
+        :param count: number of queries to be put into the queue
+        :return: True if the queries must be rejected
+        """
+        if self.max_client_queries <= 0:
+            return False
+        queued = sum(1 for query in self.query_queue for requester in self.live_requesters(query)
+                     if requester['client'] == client)
+        return self.max_client_queries < queued + count
+
+    def get_rejection_reason(self, client, count=1, attached=False):
+        """
+        Check if queries of the client must be rejected because the server is overloaded,
+        should be called with queue_lock acquired
+        :param client: client identity
+        :param count: number of queries to be put into the queue
+        :param attached: True if the queries are attached to identical queued ones and add no load
+        :return: reason of rejection (string), None if the queries are accepted
+        """
+        if self.client_queue_full(client, count):
+            return 'Too many queued queries of client "' + client + '"'
+        if not attached and self.queue_full(count):
+            return 'Query Queue is full'
+        return None
+
+    def estimate_start(self, position):
+        """
+        Estimate time until the query at the position of Query Queue is started. Pages are loaded
+        not more often than once per query_delay, and each Executor Thread takes average page load time.
+        :param position: position in Query Queue, -1 for queries answered from cache
+        :return: estimated time, in secs.
+        """
+        if position < 0:
+            return 0
+        interval = max((self.execution_time or 0) / self.workers, self.query_delay)
+        return round(position * interval, 1)
+
+    def record_execution_time(self, execution_time):
+        """
+        Update moving average of Yandex page load time
+        :param execution_time: time of the latest page load, in secs.
+        :return: nothing
+        """
+        if self.execution_time is None:
+            self.execution_time = execution_time
+        else:
+            self.execution_time += self.execution_time_weight * (execution_time - self.execution_time)
+
+    def make_overloaded_response(self, query_id, message):
+        """
+        Make response to a query rejected because Query Queue or the share of the client in it is full,
+        should be called with queue_lock acquired
+        :param query_id: ID of the query
+        :param message: reason of rejection, as returned by get_rejection_reason
+        :return: response dictionary
+        """
+        self.log.warning(message + ", query " + str(query_id) + " rejected")
+        queue_length = len(self.query_queue)
+        return {'id': query_id,
+                'response': 'OVERLOADED',
+                'message': message,
+                'queue_length': queue_length,
+                'eta': self.estimate_start(queue_length)}
+
+    @staticmethod
+    def live_requesters(query):
+        """
+        Get requesters of the query which are still waiting for its result
+        :param query: internal 'query' dictionary
+        :return: list of the query itself and identical queries attached to it, except dropped ones
+        """
+        return [requester for requester in [query] + query.get('waiters', []) if not requester.get('dropped')]
+
+    def drop_requesters(self, query, condition):
+        """
+        Drop requesters of queued query matching the condition, dropped requesters get no result.
+        The query is removed from Query Queue when all its requesters are dropped.
+        Should be called with queue_lock acquired.
+        :param query: internal 'query' dictionary, must be in the queue
+        :param condition: function of requester 'query' dictionary, True to drop it
+        :return: list of dropped requesters
+        """
+        dropped = [requester for requester in self.live_requesters(query) if condition(requester)]
+        for requester in dropped:
+            requester['dropped'] = True
+        if not self.live_requesters(query):
+            self.query_queue.remove(query)
+            if self.pending_queries.get(query.get('key')) is query:
+                del self.pending_queries[query['key']]
+        return dropped
+
+    def take_same_url_queries(self, query):
+        """
+        Take queued get... queries for the same URL as the query, of any method, out of Query Queue,
+        so they are executed together with the query with a single page load.
+        Should be called with queue_lock acquired.
+        :param query: internal 'query' dictionary, query about to be executed
+        :return: list of taken queries
+        """
+        url = query['key'][1]
+        group = [other for other in self.query_queue
+                 if other is not query and 'key' in other and other['key'][1] == url and
+                 self.pending_queries.get(other['key']) is other]
+        for other in group:
+            self.query_queue.remove(other)
+            del self.pending_queries[other['key']]
+        return group
+
+    def register_inflight(self, query_id, conn):
+        """
+        Register query ID as in flight for the connection. Query IDs are correlation keys,
+        so they must be unique among queries in flight on the connection.
+        :param query_id: ID of the query
+        :param conn: connection
+        :return: True if registered, False if the ID is already in flight (error is sent to the client)
+        """
+        if query_id in conn.inflight:
             response = {'id': query_id,
-                        'response': 'OK',
-                        'queue_position': queue_position}
-            response_json = json.dumps(response)
-            conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+                        'response': 'ERROR',
+                        'message': 'Query with this ID is already in flight'}
+            conn.send_message(response)
+            return False
+        conn.inflight.add(query_id)
+        return True
+
+    def complete_batch_item(self, batch, item, payload):
+        """
+        Tag response entries of one getBatch item. Only the last entry of the last completed item
+        has "expect_more_data" set to False.
+        :param batch: batch state shared by all items of getBatch query
+        :param item: index of the item in the batch
+        :param payload: list of response entries of the item
+        :return: nothing
+        """
+        self.queue_lock.acquire()
+        batch['pending'] -= 1
+        more_items = batch['pending'] > 0
+        self.queue_lock.release()
+
+        for entry in payload:
+            entry['item'] = item
+            entry['item_done'] = False
+            entry['expect_more_data'] = True
+        payload[-1]['item_done'] = True
+        payload[-1]['expect_more_data'] = more_items
+
+    def process_get_batch(self, query, addr, conn):
+        """
+        Process getBatch?id=?[["getStopInfo", "<url>"], ["getLine", "<url>"], ...] query.
+        Items found in preload cache are answered immediately, only the rest is put into Query Queue,
+        one after another. Each response entry is tagged with index of its item.
+        """
+        if self.watch_lock:
+            self.handle_watch_lock(conn)
+            return
+
+        _, query_id, query_body = self.split_query(query)
+        params, query_body = self.parse_query_params(query_id, query_body, conn)
+        if params is None:
+            return
+
+        try:
+            items = json.loads(query_body)
+            if not isinstance(items, list) or not items:
+                raise ValueError("list of [method, url] pairs expected")
+            for item in items:
+                if not isinstance(item, list) or len(item) != 2 or \
+                   item[0] not in self.BATCH_METHODS or not isinstance(item[1], str):
+                    raise ValueError("invalid item " + json.dumps(item))
+        except ValueError as e:
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'Invalid batch: ' + str(e)}
+            conn.send_message(response)
+            return
+
+        if not self.register_inflight(query_id, conn):
+            return
+
+        # Answer cache hits right away, collect misses
+        hits = []
+        misses = []
+        for index, (method, url) in enumerate(items):
+            payload = self.get_cached_payload(query_id, method, url, params)
+            if payload is not None:
+                hits.append((index, payload))
+            else:
+                misses.append((index, method, url))
+
+        # Misses are queued together, the batch is complete when all items are sent
+        batch = {'pending': len(items)}
+        queue_position = -1
+        self.queue_lock.acquire()
+        rejected = self.get_rejection_reason(conn.get_client_id(), len(misses))
+        if rejected is not None:
+            response = self.make_overloaded_response(query_id, rejected)
+            self.queue_lock.release()
+            conn.inflight.discard(query_id)
+            conn.send_message(response)
+            return
+        for index, method, url in misses:
+            position = self.enqueue_get_info({'type': method,
+                                              'id': query_id,
+                                              'body': url,
+                                              'fields': params['fields'],
+                                              'priority': params['priority'],
+                                              'deadline': params.get('deadline'),
+                                              'addr': addr,
+                                              'conn': conn,
+                                              'client': conn.get_client_id(),
+                                              'batch': batch,
+                                              'item': index})
+            if queue_position < 0:
+                queue_position = position
+
+        # Acknowledgment is queued before the lock is released, so it is sent before any data of the batch
+        response = {'id': query_id,
+                    'response': 'OK',
+                    'items': len(items),
+                    'cached': len(hits),
+                    'queue_position': queue_position,
+                    'eta': self.estimate_start(queue_position)}
+        conn.send_message(response)
+        self.queue_lock.release()
+
+        for index, payload in hits:
+            self.complete_batch_item(batch, index, payload)
+            conn.send_messages(payload, log_tag='getBatch')
+
+    def process_line(self, line, addr, conn):
+        """
+        Process single line received from LineFramer
+        :param line: line string, None if the line exceeded maximum query length
+        :param addr: address (from socket bind/accept)
+        :param conn: connection
+        :return: nothing
+        """
+        if line is None:
+            self.process_query_too_long(conn)
+            return
+        query = line.strip()
+        if query:
+            self.process_query(query, addr, conn)
+
+    def process_query(self, query, addr, conn):
+        """
+        Dispatch single query line to the corresponding "process_..." handler.
+        :param query: query string, already stripped
+        :param addr: address (from socket bind/accept)
+        :param conn: connection
+        :return: nothing
+        """
+        self.log.debug("Received : " + str(query))
+
+        if query == 'getCurrentQueue':
+            self.process_get_current_queue(conn)
+
+        elif query.startswith('getStopInfo?'):
+            self.process_get_stop_info(query, addr, conn)
+
+        elif query.startswith('getVehiclesInfo?'):
+            self.process_get_vehicles_info(query, addr, conn)
+
+        elif query.startswith('getVehiclesInfoWithRegion?'):
+            self.process_get_vehicles_info_with_region(query, addr, conn)
+
+        elif query.startswith('getRouteInfo?'):
+            self.process_get_route_info(query, addr, conn)
+
+        elif query.startswith('getLine?'):
+            self.process_get_line(query, addr, conn)
+
+        elif query.startswith('getLayerRegions?'):
+            self.process_get_layer_regions(query, addr, conn)
+
+        elif query.startswith('getAllInfo?'):
+            self.process_get_all_info(query, addr, conn)
+
+        elif query.startswith('getEcho?'):
+            self.process_echo(query, addr, conn)
+
+        elif query.startswith('getBatch?'):
+            self.process_get_batch(query, addr, conn)
+
+        elif query.startswith('setOptions?'):
+            self.process_set_options(query, conn)
+
+        elif query.startswith('subscribeStop?'):
+            self.process_subscribe_stop(query, conn)
+
+        elif query.startswith('unsubscribe?'):
+            self.process_unsubscribe(query, conn)
+
+        else:
+            self.process_unknown_query(conn)
 
     def process_get_stop_info(self, query, addr, conn):
         """Process get_stop_info query """
@@ -1123,15 +3209,84 @@ class Application:
     def process_get_current_queue(self, conn):
         """Process get_current_queue"""
         current_queue = self.get_current_queue()
-        queue_json = json.loads(current_queue)
-        response_json = json.dumps(queue_json)
-        conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+        conn.send_message(json.loads(current_queue))
 
     def process_unknown_query(self, conn):
         """Process unknown query"""
         response = {"response": "ERROR", "message": "Unknown query"}
-        response_json = json.dumps(response)
-        conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+        conn.send_message(response)
+
+    def process_query_too_long(self, conn):
+        """Process query exceeding maximum query length"""
+        self.log.warning("Query exceeds " + str(self.max_query_length) + " bytes, discarded")
+        response = {"response": "ERROR", "message": "Query too long"}
+        conn.send_message(response)
+
+    def process_subscribe_stop(self, query, conn):
+        """
+        Process subscribeStop?id=?<url> query. Each refresh of the URL by PreloadWorker will be pushed
+        to the connection until it unsubscribes or disconnects. Only watched stops can be subscribed to.
+        """
+        _, query_id, url = self.split_query(query)
+        if self.preload_worker is None or not self.preload_worker.is_watched(url):
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'URL is not watched by preload cache'}
+            conn.send_message(response)
+            return
+
+        with self.subscriptions_lock:
+            self.subscriptions[url][conn] = query_id
+            conn.subscriptions.add(query_id)
+        response = {'id': query_id, 'response': 'OK', 'subscribed': url}
+        conn.send_message(response)
+
+        # Send current data right away, if there is any
+        data, error = self.preload_worker.get_cached_data(url)
+        if data is not None:
+            payload = self.make_payload(query_id, 'subscribeStop', url, data, error)
+            for entry in payload:
+                entry['subscription'] = url
+            conn.send_messages(payload, log_tag='subscribeStop')
+
+    def process_unsubscribe(self, query, conn):
+        """
+        Process unsubscribe?id=?<url> query
+        """
+        _, query_id, url = self.split_query(query)
+        with self.subscriptions_lock:
+            subscription_id = self.subscriptions.get(url, {}).pop(conn, None)
+            subscribed = subscription_id is not None
+            if url in self.subscriptions and not self.subscriptions[url]:
+                del self.subscriptions[url]
+            # Same ID may be used for subscriptions to several URLs
+            if subscribed and all(ids.get(conn) != subscription_id for ids in self.subscriptions.values()):
+                conn.subscriptions.discard(subscription_id)
+        if subscribed:
+            response = {'id': query_id, 'response': 'OK', 'unsubscribed': url}
+        else:
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'Not subscribed to this URL'}
+        conn.send_message(response)
+
+    def process_set_options(self, query, conn):
+        """
+        Process setOptions?id=?framing=...&compression=...&encoding=... query.
+        Reply is sent using current framing, all further messages use the new one.
+        """
+        _, query_id, query_body = self.split_query(query)
+        options = dict(parse_qsl(query_body))
+        error = conn.check_options(options)
+        if error is not None:
+            response = {'id': query_id, 'response': 'ERROR', 'message': error}
+            conn.send_message(response)
+            return
+
+        response = {'id': query_id,
+                    'response': 'OK',
+                    'framing': options.get('framing', conn.FRAMING_TEXT),
+                    'compression': options.get('compression', conn.COMPRESSION_NONE),
+                    'encoding': options.get('encoding', conn.ENCODING_JSON),
+                    'priority': options.get('priority', QueryQueue.PRIORITY_NORMAL),
+                    'client': options.get('client')}
+        conn.set_options(options, response)
     
     def load_preload_config(self):
         """
@@ -1195,14 +3350,60 @@ class Application:
                             "   4 : full debug\n" +
                             "default is " + str(self.log.verbose))
         parser.add_argument("--delay", default=self.query_delay,
-                            help="delay between execution of queries, in seconds, default is " +
+                            help="delay between Yandex page loads, in seconds, default is " +
                             str(self.query_delay) + " secs.\n"
                             "Use this to lower the load on Yandex Maps " +
                             "and avoid possible ban for\n"
-                            "too many queries in short amount of time.")
+                            "too many queries in short amount of time.\n"
+                            "Queries answered from cache are not delayed.")
+        parser.add_argument("--burst", default=self.query_burst,
+                            help="number of pages which can be loaded at once after idle time,\n"
+                                 "before --delay applies, default is " + str(self.query_burst))
+        parser.add_argument("--workers", default=self.workers,
+                            help="number of Executor Threads, each with its own ChromeDriver, executing\n"
+                                 "queries from Query Queue in parallel, --delay and --burst limit\n"
+                                 "page loads of all of them together, default is " + str(self.workers))
+        parser.add_argument("--max-queue", default=self.max_queue,
+                            help="maximum number of queries in Query Queue, new queries are rejected\n"
+                                 "with OVERLOADED response above it, 0 for no limit, default is " +
+                                 str(self.max_queue))
+        parser.add_argument("--result-ttl", default=self.result_cache.ttl,
+                            help="time to keep results of executed queries, in seconds, queries for the\n"
+                                 "same URL and method are answered from them without loading the page,\n"
+                                 "0 to disable, default is " + str(self.result_cache.ttl))
+        parser.add_argument("--max-client-queries", default=self.max_client_queries,
+                            help="maximum number of queued queries of one client (host or client ID declared\n"
+                                 "with setOptions), 0 for no limit, default is " + str(self.max_client_queries))
         parser.add_argument("--preload-config", default=self.preload_config_file,
                             help="path to preload configuration file (JSON), default is " +
                             str(self.preload_config_file))
+        parser.add_argument("--asyncio", action="store_true", default=self.use_asyncio,
+                            help="serve connections with asyncio event loop instead of\n"
+                                 "one thread per connection")
+        parser.add_argument("--backlog", default=self.backlog,
+                            help="size of the queue of pending connections, default is " + str(self.backlog))
+        parser.add_argument("--unix-socket", default=self.unix_socket,
+                            help="path of Unix domain socket to listen on in addition to TCP port,\n"
+                                 "for clients running on the same host, default is not to listen")
+        parser.add_argument("--http-port", default=self.http_port,
+                            help="port for HTTP/1.1 gateway (GET /getStopInfo?url=...),\n"
+                                 "0 to disable, default is " + str(self.http_port))
+        parser.add_argument("--priority-aging", default=self.query_queue.aging,
+                            help="seconds of waiting in Query Queue which make up for one priority class,\n"
+                                 "so low priority queries are not starved, default is " +
+                                 str(self.query_queue.aging))
+        parser.add_argument("--max-query-length", default=self.max_query_length,
+                            help="maximum length of single query line, in bytes, default is " +
+                            str(self.max_query_length))
+        parser.add_argument("--send-queue-size", default=self.send_queue_size,
+                            help="maximum size of per-connection outbound queue, in bytes, default is " +
+                            str(self.send_queue_size))
+        parser.add_argument("--send-queue-policy", default=self.send_queue_policy,
+                            choices=[ClientConnection.POLICY_DISCONNECT, ClientConnection.POLICY_DROP_OLDEST],
+                            help="what to do if outbound queue of the client overflows:\n" +
+                            "   disconnect  : drop the client\n" +
+                            "   drop_oldest : drop oldest messages from the queue\n" +
+                            "default is " + str(self.send_queue_policy))
 
         args = parser.parse_args()
         if args.version:
@@ -1212,8 +3413,23 @@ class Application:
         self.host = str(args.host)
         self.port = int(args.port)
         self.log.verbose = int(args.verbose)
-        self.query_delay = int(args.delay)
+        self.query_delay = float(args.delay)
+        self.query_burst = max(1, int(args.burst))
+        self.workers = max(1, int(args.workers))
+        self.max_queue = int(args.max_queue)
+        self.max_client_queries = int(args.max_client_queries)
+        # Fair share of each client is one page load interval
+        self.query_queue.share = max(self.query_delay, 1)
+        self.result_cache.ttl = float(args.result_ttl)
         self.preload_config_file = str(args.preload_config)
+        self.use_asyncio = bool(args.asyncio)
+        self.http_port = int(args.http_port)
+        self.unix_socket = args.unix_socket
+        self.backlog = int(args.backlog)
+        self.query_queue.aging = float(args.priority_aging)
+        self.max_query_length = int(args.max_query_length)
+        self.send_queue_size = int(args.send_queue_size)
+        self.send_queue_policy = str(args.send_queue_policy)
 
     def run(self):
         """
@@ -1228,22 +3444,28 @@ class Application:
         self.log.info("YTPS - Yandex Transport Proxy Server - starting up...")
         self.log.info("Listen host : " + str(self.host))
         self.log.info("Listen port : " + str(self.port))
-        self.log.info("Delay       : " + str(self.query_delay))
+        self.log.info("Delay       : " + str(self.query_delay) + ", burst " + str(self.query_burst))
+        self.log.info("Workers     : " + str(self.workers))
         self.log.info("Verbosity   : " + str(self.log.verbose))
+        self.log.info("Server mode : " + ("asyncio" if self.use_asyncio else "threaded"))
+        self.log.info("HTTP port   : " + (str(self.http_port) if self.http_port else "disabled"))
 
         # Signal handler
         signal.signal(signal.SIGINT, self.sigint_handler)
         signal.signal(signal.SIGTERM, self.sigterm_handler)
 
-        # Starting query executor thread
-        self.executor_thread = ExecutorThread(self)
-        self.executor_thread.start()
-
-        # Calling Yandex Transport API Core
-        self.core = YandexTransportCore(self.log.verbose)
-        self.log.info("Starting ChromeDriver...")
-        self.core.start_webdriver()
-        self.log.info("ChromeDriver started successfully!")
+        # Starting query executor threads, each with its own Yandex Transport API Core,
+        # Yandex page loads of all of them are paced by the same rate limiter
+        self.rate_limiter = TokenBucket(self.query_delay, self.query_burst)
+        for number in range(1, self.workers + 1):
+            core = YandexTransportCore(self.log.verbose)
+            self.log.info("Starting ChromeDriver " + str(number) + " of " + str(self.workers) + "...")
+            core.start_webdriver()
+            self.log.info("ChromeDriver started successfully!")
+            self.cores.append(core)
+            executor_thread = ExecutorThread(self, core, self.rate_limiter)
+            executor_thread.start()
+            self.executor_threads.append(executor_thread)
         
         # Load and start preload worker if configured
         if self.load_preload_config():
@@ -1258,13 +3480,25 @@ class Application:
         else:
             self.log.info("Preload cache not enabled")
 
+        # Start HTTP gateway if enabled
+        if self.http_port:
+            self.http_gateway = HttpGatewayThread(self)
+            if self.http_gateway.bind():
+                self.http_gateway.start()
+            else:
+                self.log.error("Failed to bind HTTP gateway socket.")
+                self.http_gateway = None
+
         # Start the process of listening and accepting incoming connections.
         result = self.listen()
         if result == self.RESULT_SOCKET_BIND_FAILED:
             self.log.error("Failed to bind socket.")
 
+        if self.http_gateway is not None:
+            self.http_gateway.stop()
 
-        self.core.stop_webdriver()
+        for core in self.cores:
+            core.stop_webdriver()
 
         # Stopping the server executor and listener threads.
         self.is_running = False
@@ -1272,8 +3506,8 @@ class Application:
         for _, listener in self.listeners.items():
             listener.join()
 
-        if self.executor_thread is not None:
-            self.executor_thread.join()
+        for executor_thread in self.executor_threads:
+            executor_thread.join()
         self.log.info("YTPS - Yandex Transport Proxy Server - terminated!")
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -36,6 +36,10 @@ class YandexTransportCore:
     RESULT_JSON_PARSE_ERROR = 4
     RESULT_GET_ERROR = 5
 
+    # With wait_all, seconds to wait for the rest of API methods after the first one appears,
+    # methods which are not loaded by the page are not waited for up to the full timeout
+    WAIT_ALL_EXTRA = 5
+
     def __init__(self, log_level=None):
         self.driver = None
         self.log = Logger(log_level) if log_level is not None else None
@@ -230,12 +234,16 @@ class YandexTransportCore:
 
     # ----                               MASTER FUNCTION TO GET YANDEX API DATA                                   ---- #
 
-    def _get_yandex_json(self, url, api_method):
+    def _get_yandex_json(self, url, api_method, wait_all=False, on_entry=None):
         """
         Universal method to get Yandex JSON results.
         :param url: initial url, get it by clicking on the route or stop
         :param api_method: tuple of strings to find,
                like ("maps/api/masstransit/get_route_info","maps/api/masstransit/get_vehicles_info")
+        :param wait_all: wait until all of api_method appear in network logs, not just the first one,
+               but no more than WAIT_ALL_EXTRA seconds after the first one
+        :param on_entry: function called with each result entry as soon as it is extracted, and list of
+               local API methods of entries still to be extracted, None if not needed
         :return: array of huge json data, error code
         """
 
@@ -298,6 +306,7 @@ class YandexTransportCore:
         check_interval = 1
         waited = 0
         api_found = False
+        methods_found = set()
         accumulated_logs = []
         
         while waited < max_wait:
@@ -318,7 +327,10 @@ class YandexTransportCore:
                             # Check if any of the target API methods is in this URL
                             for method in api_method:
                                 if method in url:
-                                    api_found = True
+                                    if wait_all and not methods_found:
+                                        max_wait = min(max_wait, waited + self.WAIT_ALL_EXTRA)
+                                    methods_found.add(method)
+                                    api_found = not wait_all or len(methods_found) == len(api_method)
                                     if self.log:
                                         self.log.info(f"Found {method} after {waited} seconds")
                                     break
@@ -385,7 +397,7 @@ class YandexTransportCore:
 
         # Getting last API query results from cache by executing it again in the browser
         if last_query:                    # Same meaning as in "if len(last_query) > 0:"
-            for query in last_query:
+            for index, query in enumerate(last_query):
                 # Getting the webpage based on URL
                 try:
                     self.driver.get(query['url'])
@@ -428,6 +440,8 @@ class YandexTransportCore:
                             "error": "Failed to parse body of the response"}
 
                 result_list.append(data)
+                if on_entry is not None:
+                    on_entry(data, [self.yandex_api_to_local_api(other['method']) for other in last_query[index + 1:]])
 
         else:
             return result_list, self.RESULT_NO_LAST_QUERY
@@ -436,60 +450,79 @@ class YandexTransportCore:
 
     # ----                                   SHORTCUTS TO USED APIs                                               ---- #
 
-    def get_stop_info(self, url):
+    def get_stop_info(self, url, on_entry=None):
         """
         Getting Yandex masstransit get_stop_info JSON results
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         
         Note: As of 2026, getStopInfo still exists but loads later (needs 5-10s wait)
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getStopInfo",))
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getStopInfo",), on_entry=on_entry)
 
-    def get_vehicles_info(self, url):
+    def get_vehicles_info(self, url, on_entry=None):
         """
         Getting Yandex masstransit get_vehicles_info JSON results
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfo",))
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfo",), on_entry=on_entry)
 
-    def get_vehicles_info_with_region(self, url):
+    def get_vehicles_info_with_region(self, url, on_entry=None):
         """
         Getting Yandex masstransit get_vehicles_info JSON results
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfoWithRegion",))
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfoWithRegion",),
+                                     on_entry=on_entry)
 
-    def get_route_info(self, url):
+    def get_route_info(self, url, on_entry=None):
         """
         Getting Yandex masstransit get_route_info JSON results
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getRouteInfo",))
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getRouteInfo",), on_entry=on_entry)
 
-    def get_line(self, url):
+    def get_line(self, url, on_entry=None):
         """
         Getting Yandex masstransit get_line JSON results
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLine",))
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLine",), on_entry=on_entry)
 
-    def get_layer_regions(self, url):
+    def get_layer_regions(self, url, on_entry=None):
         """
         No idea what this thing does
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
+        :return: array of huge json data, error code
+        """
+        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLayerRegions",), on_entry=on_entry)
+
+    def get_methods_info(self, url, methods, on_entry=None):
+        """
+        Getting Yandex Masstransit API JSON results of several methods with a single page load
+        :param url: url of the stop or route
+        :param methods: local API methods, like ("getStopInfo", "getVehiclesInfo")
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLayerRegions",))
+        return self._get_yandex_json(url, api_method=tuple("maps/api/masstransit/" + method for method in methods),
+                                     wait_all=True, on_entry=on_entry)
 
-    def get_all_info(self, url):
+    def get_all_info(self, url, on_entry=None):
         """
         Getting basically all Yandex Masstransit API JSON results related to requested URL
         :param url:
+        :param on_entry: function called with each entry as soon as it is extracted, see _get_yandex_json
         :return:
         """
         return self._get_yandex_json(url, api_method=("maps/api/masstransit/getRouteInfo",
@@ -497,8 +530,8 @@ class YandexTransportCore:
                                                       "maps/api/masstransit/getStopInfo",
                                                       "maps/api/masstransit/getVehiclesInfo",
                                                       "maps/api/masstransit/getVehiclesInfoWithRegion",
-                                                      "maps/api/masstransit/getLayerRegions")
-                                     )
+                                                      "maps/api/masstransit/getLayerRegions"),
+                                     on_entry=on_entry)
 
 
 if __name__ == '__main__':